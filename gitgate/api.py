@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+JSON API, mounted at /api/v1.
+
+Requests are authenticated with the web session cookie, or with HTTP
+basic auth using a user's email address and password. Review actions go
+through Commit.apply_action, so they follow the same rules as the
+buttons on the commit page.
+"""
+import flask as f
+import hashlib
+import models as md
+from webapp import get_user, get_project, touched_paths, DIFF_TIMEOUT
+
+api = f.Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Most commits a single bulk action may name
+BULK_LIMIT = 500
+
+def error(message, code=400):
+    response = f.jsonify(error=message)
+    response.status_code = code
+    return response
+
+def api_user():
+
+    """ Returns the session's user, or the user named by basic auth """
+
+    user = get_user()
+    auth = f.request.authorization
+    if user or not auth:
+        return user
+    try:
+        user = md.User.get(email=auth.username,
+            password=hashlib.sha1(auth.password).hexdigest())
+    except md.User.DoesNotExist:
+        return None
+    f.g.user = user
+    return user
+
+@api.before_request
+def check_request():
+    if not api_user():
+        return error('Authentication required', 401)
+    try:
+        get_project()
+    except md.Project.DoesNotExist:
+        f.abort(404)
+
+@api.errorhandler(404)
+def not_found(err):
+    return error('Not found', 404)
+
+def date_json(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+def commit_json(commit):
+    return {
+        'id': commit.id,
+        'sha1': commit.sha1,
+        'branch': commit.branch,
+        'project': commit.project_id,
+        'author_date': date_json(commit.author_date),
+        'author_name': commit.author_name,
+        'author_email': commit.author_email,
+        'message': commit.message,
+        'status': commit.status,
+    }
+
+def get_commit(cid):
+    try:
+        return md.Commit.get((md.Commit.id == cid)
+            & (md.Commit.project == get_project()))
+    except md.Commit.DoesNotExist:
+        f.abort(404)
+
+@api.route('/projects/<int:pid>/commits')
+def commits(pid):
+
+    """ Lists a project's commits, newest first
+
+    GET param status - comma separated statuses, defaults to all
+    GET param limit - int: page size, at most 200
+    GET param before - int: id of the last commit of the newer page
+    GET param after - int: id of the first commit of the older page
+    """
+
+    try:
+        limit = min(int(f.request.args.get('limit', 50)), 200)
+        before = int(f.request.args.get('before', 0)) or None
+        after = int(f.request.args.get('after', 0)) or None
+    except ValueError:
+        return error('limit, before and after must be integers')
+    statuses = [s for s in f.request.args.get('status', '').split(',') if s]
+
+    commits, has_newer, has_older = md.Commit.page(get_project(),
+        statuses or None, limit=limit, before=before, after=after)
+    return f.jsonify(commits=[commit_json(c) for c in commits],
+        has_newer=has_newer, has_older=has_older)
+
+@api.route('/projects/<int:pid>/file')
+def file_history(pid):
+
+    """ Lists the commits that touched a file, or any file under a 
+    directory, most recently recorded first, each with the paths it 
+    touched there
+
+    GET param path - string: the file or directory
+    GET param status, limit, before, after - as for commits
+    """
+
+    path = f.request.args.get('path', '').strip('/')
+    if not path:
+        return error('path is required')
+    try:
+        limit = min(int(f.request.args.get('limit', 50)), 200)
+        before = int(f.request.args.get('before', 0)) or None
+        after = int(f.request.args.get('after', 0)) or None
+    except ValueError:
+        return error('limit, before and after must be integers')
+    statuses = [s for s in f.request.args.get('status', '').split(',') if s]
+
+    commits, has_newer, has_older = md.Commit.page(get_project(),
+        statuses or None, limit=limit, before=before, after=after, 
+        path=path)
+    touched = touched_paths(commits, path)
+    data = []
+    for commit in commits:
+        data.append(commit_json(commit))
+        data[-1]['paths'] = touched.get(commit.id, [])
+    return f.jsonify(path=path, commits=data, has_newer=has_newer, 
+        has_older=has_older)
+
+@api.route('/projects/<int:pid>/search')
+def search(pid):
+
+    """ Searches a project's commits, best matches first
+
+    GET param q - words to look for in messages, authors and paths
+    GET param path - string: start of a file path
+    GET param author - string: start of an author's name or email
+    GET param status - comma separated statuses, defaults to all
+    GET param limit - int: page size, at most 200
+    GET param offset - int: number of results to skip
+    """
+
+    if not md.CommitSearch.exists():
+        return error('Search is not available on this site', 501)
+    try:
+        limit = min(int(f.request.args.get('limit', 50)), 200)
+        offset = max(int(f.request.args.get('offset', 0)), 0)
+    except ValueError:
+        return error('limit and offset must be integers')
+    statuses = [s for s in f.request.args.get('status', '').split(',') if s]
+
+    commits, has_more = md.CommitSearch.search(get_project(),
+        text=f.request.args.get('q'), path=f.request.args.get('path'),
+        author=f.request.args.get('author'), statuses=statuses,
+        limit=limit, offset=offset)
+    return f.jsonify(commits=[commit_json(c) for c in commits],
+        has_more=has_more)
+
+@api.route('/projects/<int:pid>/commits/<int:cid>')
+def commit(pid, cid):
+
+    """ Returns a commit with its files and log """
+
+    commit = get_commit(cid)
+    data = commit_json(commit)
+
+    counts = dict((d.file_path, d) for d in md.CommitFileDiff
+        .select(md.CommitFileDiff.file_path, md.CommitFileDiff.added,
+            md.CommitFileDiff.removed)
+        .where((md.CommitFileDiff.commit == commit)
+            & (md.CommitFileDiff.diff_key != md.CommitFileDiff.FAILED)))
+    data['files'] = []
+    for cf in commit.files.order_by(md.CommitFile.file_path):
+        counted = counts.get(cf.file_path)
+        data['files'].append({
+            'path': cf.file_path,
+            'change_type': cf.change_type,
+            'added': counted.added if counted else None,
+            'removed': counted.removed if counted else None,
+        })
+
+    logs = (md.CommitLog
+        .select(md.CommitLog, md.User)
+        .join(md.User, md.JOIN_LEFT_OUTER)
+        .where(md.CommitLog.commit == commit)
+        .order_by(md.CommitLog.created, md.CommitLog.id))
+    data['logs'] = [{
+        'id': log.id,
+        'created': date_json(log.created),
+        'user': log.user.email if log.user_id else None,
+        'message': log.message,
+    } for log in logs]
+    return f.jsonify(data)
+
+@api.route('/projects/<int:pid>/commits/<int:cid>/diff')
+def commit_diff(pid, cid):
+
+    """ Returns the unified diff of one of a commit's files against
+    stable
+
+    GET param path - the file's path in the repository
+    GET param context - int: lines of context, at most 200
+    """
+
+    commit = get_commit(cid)
+    fpath = f.request.args.get('path')
+    try:
+        md.CommitFile.get(commit=commit, file_path=fpath)
+    except md.CommitFile.DoesNotExist:
+        f.abort(404)
+    try:
+        context = min(int(f.request.args.get('context', 3)), 200)
+    except ValueError:
+        return error('context must be an integer')
+
+    git_control = get_project().git_control
+    unified = git_control.file_diff(commit.sha1, fpath,
+        branch=commit.branch, context=context, timeout=DIFF_TIMEOUT)
+    return f.jsonify(
+        path=fpath,
+        diff_key=git_control.get_diff_key(commit.sha1, fpath,
+            branch=commit.branch, context=context),
+        diff=''.join(unified),
+        degraded=unified.degraded)
+
+@api.route('/projects/<int:pid>/commits/<action>', methods=['POST'])
+def bulk_action(pid, action):
+
+    """ Applies a review action to several commits in one transaction.
+    Takes a JSON body of {"ids": [commit ids], "message": comment} and
+    returns a result for each id, in order. Commits the action isn't
+    allowed on are reported and skipped; the rest still apply. """
+
+    if action not in md.Commit.ACTIONS:
+        f.abort(404)
+    data = f.request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not ids:
+        return error('ids must be a list of commit ids')
+    if len(ids) > BULK_LIMIT:
+        return error('At most %d commits per request'%(BULK_LIMIT))
+    try:
+        ids = [int(cid) for cid in ids]
+    except (TypeError, ValueError):
+        return error('ids must be a list of commit ids')
+
+    user = api_user()
+    commits = dict((c.id, c) for c in md.Commit.select()
+        .where((md.Commit.id << ids) & (md.Commit.project == get_project())))
+    results = []
+    with md.write_transaction():
+        for cid in ids:
+            commit = commits.get(cid)
+            if commit is None:
+                results.append({'id': cid, 'ok': False, 'code': 404,
+                    'error': 'Commit not found'})
+                continue
+            try:
+                commit.apply_action(user, action, data.get('message'))
+            except md.ActionError as err:
+                results.append({'id': cid, 'ok': False, 'code': err.code,
+                    'error': err.message})
+                continue
+            results.append({'id': cid, 'ok': True, 'status': commit.status})
+    return f.jsonify(results=results)
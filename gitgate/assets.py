@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Content fingerprints and gzipped copies of the files under static/.
+Each is worked out once per version of a file and kept in memory; a
+"<file>.gz" next to the file, if newer, is used as is.
+"""
+import cStringIO
+import gzip
+import hashlib
+import os
+
+# Extensions worth compressing. Fonts like woff and images already are.
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ttf', '.eot', '.html', '.txt')
+
+_fingerprints = {}
+_gzipped = {}
+
+def _version(path):
+    try:
+        return path, os.path.getmtime(path)
+    except OSError:
+        return None
+
+def fingerprint(path):
+
+    """ Returns a short hash of the file's contents, or None if there's
+    no such file """
+
+    version = _version(path)
+    if version is None:
+        return None
+    if version not in _fingerprints:
+        with open(path, 'rb') as fh:
+            _fingerprints[version] = hashlib.sha1(fh.read()).hexdigest()[:12]
+    return _fingerprints[version]
+
+def gzipped(path):
+
+    """ Returns the file's contents gzipped, or None if there's no such
+    file or it isn't worth compressing """
+
+    version = _version(path)
+    if version is None or not path.lower().endswith(COMPRESSIBLE):
+        return None
+    if version in _gzipped:
+        return _gzipped[version]
+
+    precompressed = _version(path + '.gz')
+    if precompressed and precompressed[1] >= version[1]:
+        with open(path + '.gz', 'rb') as fh:
+            data = fh.read()
+    else:
+        buf = cStringIO.StringIO()
+        gz = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+        with open(path, 'rb') as fh:
+            gz.write(fh.read())
+        gz.close()
+        data = buf.getvalue()
+    _gzipped[version] = data
+    return data
@@ -0,0 +1,189 @@
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+
+class LRUCache(object):
+
+    """ A thread safe in-memory cache of strings, evicting the least 
+    recently used entries once it holds more than max_bytes """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                old_key, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+class DiskCache(object):
+
+    """ Keeps strings as files under path, removing the least recently
+    used ones once they take up more than max_bytes """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.size = sum(os.path.getsize(p) for p in self.files())
+
+    def files(self):
+        return [os.path.join(self.path, name) 
+            for name in os.listdir(self.path) if name.endswith('.cache')]
+
+    def filename(self, key):
+        return os.path.join(self.path, 
+            hashlib.sha1(key).hexdigest() + '.cache')
+
+    def get(self, key):
+        fname = self.filename(key)
+        try:
+            with open(fname, 'rb') as fh:
+                value = fh.read()
+            # Reads refresh the mtime, which is what eviction goes by
+            os.utime(fname, None)
+        except (IOError, OSError):
+            return None
+        return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        fd, tmp_name = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(value)
+        fname = self.filename(key)
+        with self.lock:
+            try:
+                self.size -= os.path.getsize(fname)
+            except OSError:
+                pass
+            os.rename(tmp_name, fname)
+            self.size += len(value)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+
+        """ Removes the oldest files until 3/4 of max_bytes is used """
+
+        stats = []
+        for fname in self.files():
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            stats.append((st.st_mtime, st.st_size, fname))
+        stats.sort()
+        self.size = sum(s[1] for s in stats)
+        for mtime, size, fname in stats:
+            if self.size <= self.max_bytes * 3 / 4:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            self.size -= size
+
+    def clear(self):
+        with self.lock:
+            for fname in self.files():
+                os.remove(fname)
+            self.size = 0
+
+class DiffCache(object):
+
+    """ Rendered diffs, kept in memory and optionally on disk.
+    Keys name the exact blobs being compared (see 
+    GitProject.get_diff_key), so an entry never goes stale: when the
+    stable tip changes a file, its diffs get a new key and the old
+    entries age out. """
+
+    def __init__(self, memory_bytes, disk_path=None, disk_bytes=0):
+        self.memory = LRUCache(memory_bytes)
+        self.disk = None
+        if disk_path and disk_bytes:
+            self.disk = DiskCache(disk_path, disk_bytes)
+        self.counts = collections.Counter()
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self.counts['memory_hits'] += 1
+            return value
+        if self.disk:
+            value = self.disk.get(key)
+            if value is not None:
+                self.counts['disk_hits'] += 1
+                self.memory.set(key, value)
+                return value
+        self.counts['misses'] += 1
+        return None
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk:
+            self.disk.set(key, value)
+
+    def tee(self, key, chunks, cacheable=None):
+
+        """ Yields chunks through, caching them under key once they've
+        all been produced, unless they outgrow the memory tier or 
+        cacheable() is false by then """
+
+        parts = []
+        size = 0
+        for chunk in chunks:
+            if parts is not None:
+                parts.append(chunk)
+                size += len(chunk)
+                if size > self.memory.max_bytes:
+                    parts = None
+            yield chunk
+        if parts is not None and (cacheable is None or cacheable()):
+            self.set(key, ''.join(parts))
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk:
+            self.disk.clear()
+
+    def stats(self):
+        stats = {
+            'memory_hits':self.counts['memory_hits'],
+            'disk_hits':self.counts['disk_hits'],
+            'misses':self.counts['misses'],
+            'memory_entries':len(self.memory.entries),
+            'memory_bytes':self.memory.size,
+            'memory_max_bytes':self.memory.max_bytes,
+        }
+        if self.disk:
+            stats['disk_bytes'] = self.disk.size
+            stats['disk_max_bytes'] = self.disk.max_bytes
+        return stats
@@ -1,10 +1,20 @@
 #!/usr/bin/env python
 import models as dbm
+import gittrace
+import metrics
+import migrations
+import util
+import zlib
+import diff
+from diff import render_html
 import time
 import logging
 import sys
 import re
 import datetime
+import json
+import threading
+from multiprocessing.pool import ThreadPool
 import ggconf
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
@@ -14,6 +24,22 @@ on_commit = None
 on_merge = None
 running = False
 
+POLL_MIN_INTERVAL = getattr(ggconf, 'POLL_MIN_INTERVAL', 10)
+POLL_MAX_INTERVAL = getattr(ggconf, 'POLL_MAX_INTERVAL', 300)
+MERGE_BATCH_SIZE = getattr(ggconf, 'MERGE_BATCH_SIZE', 0)
+DIFF_PRERENDER_LIMIT = getattr(ggconf, 'DIFF_PRERENDER_LIMIT', 200)
+DIFF_PRERENDER_MAX_BYTES = getattr(ggconf, 'DIFF_PRERENDER_MAX_BYTES', 
+    1024 * 1024)
+DIFF_PRERENDER_RETRY = getattr(ggconf, 'DIFF_PRERENDER_RETRY', 60 * 60)
+DIFF_RETENTION_DAYS = getattr(ggconf, 'DIFF_RETENTION_DAYS', 30)
+DIFF_TIMEOUT = getattr(ggconf, 'DIFF_TIMEOUT', diff.DEFAULT_TIMEOUT)
+DAEMON_METRICS_HOST = getattr(ggconf, 'DAEMON_METRICS_HOST', '127.0.0.1')
+DAEMON_METRICS_PORT = getattr(ggconf, 'DAEMON_METRICS_PORT', 0)
+# The commit file view's default amount of context
+PRERENDER_CONTEXT = 1
+
+_project_locks = {}
+_project_locks_lock = threading.Lock()
 
 
 def clone_commit(new_sha1, old_sha1, file_changes, details):
@@ -28,101 +54,395 @@ def clone_commit(new_sha1, old_sha1, file_changes, details):
     new_date = details.get('author_date', datetime.datetime.now)
 
     commit = old_commit.clone(new_sha1=new_sha1, 
-        new_author_date=new_date, clone_files=True)
+        new_author_date=new_date, clone_files=False)
     
+    # The new commit's own changes replace the cloned ones
     file_paths = [f[1] for f in file_changes]
+    cloned = [[cf.change_type, cf.file_path] for cf in old_commit.files
+        if cf.file_path not in file_paths]
+    dbm.CommitFile.bulk_create(commit, cloned + file_changes)
+
+    return commit
+
+def ingest_commit(project, branch, details):
+
+    """ Records a single commit from GitProject.get_commits """
 
-    for old_cf in commit.files:
-        if old_cf.file_path in file_paths:        
-            old_cf.delete_instance()
+    sha1 = details['sha1']
+    file_changes = details['file_changes']
 
-    for status, fpath in file_changes:
-        dbm.CommitFile.create(
-            commit=commit,
-            change_type=status,
-            file_path=fpath)
+    if not file_changes:
+        logger.info('No file changes in %s'%(sha1))
+        return None
+
+    message = details['message']
+    commit = None
+
+    ### Check for special handling
+
+    # Check for "clone" 
+    inc_match = re.search(r'clone:([a-zA-Z0-9]{20,45})', message)
+    if inc_match:
+        old_sha1 = inc_match.group(1)
+        commit = clone_commit(old_sha1=old_sha1, new_sha1=sha1,
+            file_changes=file_changes, details=details)
+    
+    # Create the commit and its files
+    if not commit:    
+        commit = dbm.Commit.create(sha1=sha1, project=project, branch=branch,
+            author_date=details['author_date'], author_name=details['author_name'],
+            author_email=details['author_email'], status='committed',
+            message=details['message'])
+        dbm.CommitFile.bulk_create(commit, file_changes)
 
+    dbm.CommitSearch.add(commit, [cf.file_path for cf in commit.files])
     return commit
 
 def check_for_commits(project, branch='master'):
     sha1s = project.git_control.get_sha1_diffs(branch=branch)
-    handled_sha1s = [c.sha1 for c in project.commits]
+    handled_sha1s = dbm.Commit.existing_sha1s(sha1s)
 
+    new_sha1s = []
     for sha1 in sha1s:
         logger.info("Found commit: %s"%(sha1))
         if sha1 in handled_sha1s:
             logger.info('Already handled')
             continue
+        new_sha1s.append(sha1)
 
-        file_changes = project.git_control.get_commit_file_changes(sha1)
+    if not new_sha1s:
+        return []
 
-        if not file_changes:
-            logger.info('No file changes')
-            continue
+    # Read everything from git first so the write transaction stays short
+    found = project.git_control.get_commits(new_sha1s)
 
-        details = project.git_control.get_commit_details(sha1)
-        message = details['message']
-        commit = None
-
-        ### Check for special handling
-
-        # Check for "clone" 
-        inc_match = re.search(r'clone:([a-zA-Z0-9]{20,45})', message)
-        if inc_match:
-            old_sha1 = inc_match.group(1)
-            commit = clone_commit(old_sha1=old_sha1, new_sha1=sha1,
-                file_changes=file_changes, details=details)
-        
-        
-        # Create the commit and its files
-        if not commit:    
-            commit = dbm.Commit.create(sha1=sha1, project=project, branch=branch,
-                author_date=details['author_date'], author_name=details['author_name'],
-                author_email=details['author_email'], status='committed',
-                message=details['message'])
-        
-            for change in file_changes:
-                cf = dbm.CommitFile.create(file_path=change[1], change_type=change[0], commit=commit)
+    commits = []
+    with dbm.write_transaction():
+        for details in found:
+            commit = ingest_commit(project, branch, details)
+            if commit:
+                commits.append(commit)
 
+    for commit in commits:
         if on_commit:
             on_commit(commit)
     
-        logger.info('Done')
+    metrics.commits_ingested.inc(len(commits), project=project.name, 
+        branch=branch)
+    logger.info('Recorded %d new commits'%(len(commits)))
+    return commits
+
+def merge_batch(project, branch, commits):
+
+    """ Merges a run of approved commits into a branch with a single
+    push. Returns False if the batch was rolled back. """
+
+    logger.info('Merging %d commits into %s'%(len(commits), branch))
+    try:
+        project.git_control.merge_commits([c.sha1 for c in commits], 
+            branch=branch)
+    except util.MergeError as err:
+        metrics.merge_batches.inc(project=project.name, branch=branch,
+            result='failed')
+        logger.exception(err)
+        if not err.sha1:
+            logger.warning('Could not push merges, will retry')
+            return False
+        for commit in commits:
+            if commit.sha1 == err.sha1:
+                logger.warning('Could not merge commit %s due to above '
+                    'exception'%(commit.sha1))
+                commit.status = 'outdated'
+                commit.save()
+        return False
+    except Exception as err:
+        metrics.merge_batches.inc(project=project.name, branch=branch,
+            result='failed')
+        logger.exception(err)
+        logger.warning('Could not merge commits, will retry')
+        return False
+
+    with dbm.write_transaction():
+        for commit in commits:
+            commit.status = 'merged'
+            commit.save()
+    metrics.merge_batches.inc(project=project.name, branch=branch,
+        result='succeeded')
+    metrics.commits_merged.inc(len(commits), project=project.name,
+        branch=branch)
+    return True
 
 def handle_approved(project):
-    commits = (
-        dbm.Commit.select()
-        .where((dbm.Commit.status == 'approved') & (dbm.Commit.project == project))
-        .order_by(dbm.Commit.author_date.asc()))
-    
-    for commit in commits:
-        logger.info('Working on commit: %s'%(commit.sha1))
-        if not commit.can_merge:
-            logger.info("Can't merge")
-            continue
+    conflicts = dbm.FileConflictIndex(project)
+    branches = {}
+    for commit in conflicts.mergeable():
+        branches.setdefault(commit.branch, []).append(commit)
+
+    for branch, commits in sorted(branches.items()):
+        size = MERGE_BATCH_SIZE or len(commits)
+        for i in range(0, len(commits), size):
+            # Later batches may depend on the files of a failed one
+            if not merge_batch(project, branch, commits[i:i + size]):
+                break
+
+def render_diff_row(git_control, cf):
+
+    """ Renders a commit file's diff as a CommitFileDiff row, or returns
+    None if it ran out of time, as that diff isn't worth keeping """
+
+    commit = cf.commit
+    diff_key = git_control.get_diff_key(commit.sha1, cf.file_path,
+        branch=commit.branch, context=PRERENDER_CONTEXT)
+    unified = git_control.file_diff(commit.sha1, cf.file_path,
+        branch=commit.branch, context=PRERENDER_CONTEXT, 
+        timeout=DIFF_TIMEOUT)
+    lines = list(unified)
+    if unified.degraded:
+        return None
+    html = ''.join(render_html(lines))
+    data = None
+    if len(html) <= DIFF_PRERENDER_MAX_BYTES:
+        data = zlib.compress(html)
+    return {
+        'commit':commit,
+        'file_path':cf.file_path,
+        'diff_key':diff_key,
+        'data':data,
+        'added':len([l for l in lines if l.startswith('+')]),
+        'removed':len([l for l in lines if l.startswith('-')]),
+    }
+
+def prerender_diffs(project, limit=DIFF_PRERENDER_LIMIT):
+
+    """ Renders and stores the diffs of pending commits' files that
+    don't have one yet, oldest commits first, at most limit per call.
+    A file that fails to render is stored as failed, so it doesn't hold
+    up the files after it, and tried again DIFF_PRERENDER_RETRY seconds
+    later, as git errors and timeouts can pass. """
+
+    retry = datetime.datetime.now() - datetime.timedelta(
+        seconds=DIFF_PRERENDER_RETRY)
+    (dbm.CommitFileDiff
+        .delete()
+        .where((dbm.CommitFileDiff.diff_key == dbm.CommitFileDiff.FAILED)
+            & (dbm.CommitFileDiff.created < retry)
+            & (dbm.CommitFileDiff.commit << dbm.Commit
+                .select(dbm.Commit.id)
+                .where(dbm.Commit.project == project)))
+        .execute())
+
+    missing = (dbm.CommitFile
+        .select(dbm.CommitFile, dbm.Commit)
+        .join(dbm.Commit)
+        .switch(dbm.CommitFile)
+        .join(dbm.CommitFileDiff, dbm.JOIN_LEFT_OUTER, on=(
+            (dbm.CommitFileDiff.commit == dbm.CommitFile.commit) &
+            (dbm.CommitFileDiff.file_path == dbm.CommitFile.file_path)))
+        .where((dbm.Commit.project == project)
+            & (dbm.Commit.status << list(dbm.Commit.PENDING_STATUSES))
+            & (dbm.CommitFile.change_type != 'D')
+            & (dbm.CommitFileDiff.file_path >> None))
+        .order_by(dbm.Commit.author_date.asc())
+        .limit(limit))
+
+    git_control = project.git_control
+    rows = []
+    failed = 0
+    # Rendering can take a while, so don't hold the read open meanwhile
+    for cf in list(missing):
         try:
-            project.git_control.merge_commit(commit.sha1, branch=commit.branch)    
-            commit.status = 'merged'
+            row = render_diff_row(git_control, cf)
+            if row is None:
+                logger.warning('Diff of %s of %s ran out of time'%(
+                    cf.file_path, cf.commit.sha1))
+        except Exception as err:
+            logger.exception(err)
+            logger.warning('Could not render %s of %s'%(cf.file_path,
+                cf.commit.sha1))
+            row = None
+        if row is None:
+            failed += 1
+            row = {
+                'commit':cf.commit,
+                'file_path':cf.file_path,
+                'diff_key':dbm.CommitFileDiff.FAILED,
+                'data':None,
+            }
+        rows.append(row)
+
+    with dbm.write_transaction():
+        for i in range(0, len(rows), 100):
+            dbm.CommitFileDiff.insert_many(rows[i:i + 100]).execute()
+    if rows:
+        logger.info('Rendered %d diffs for %s, %d failed'%(
+            len(rows) - failed, project.name, failed))
+    return len(rows)
+
+def prerender_worker():
+
+    """ Renders diffs for each project in turn, in the background, so
+    polling and merging never wait on it. Diffs are read from git
+    objects, so no project lock is needed. Sleeps once there's nothing
+    left to render. """
+
+    while True:
+        rendered = 0
+        try:
+            for project in dbm.Project.select().order_by(dbm.Project.id):
+                rendered += prerender_diffs(project)
         except Exception as err:
             logger.exception(err)
-            logger.warning('Could not merge commit due to above exception')
-            commit.status = 'outdated'
-        commit.save()
+        if not rendered:
+            time.sleep(POLL_MIN_INTERVAL)
+
+def prune_diffs():
+
+    """ Drops the stored HTML of diffs for commits merged, outdated or
+    rejected more than DIFF_RETENTION_DAYS ago, keeping their line
+    counts """
+
+    cutoff = datetime.datetime.now() - datetime.timedelta(
+        days=DIFF_RETENTION_DAYS)
+    closed = (dbm.Commit
+        .select(dbm.Commit.id)
+        .where((dbm.Commit.status << list(dbm.Commit.CLOSED_STATUSES))
+            & (dbm.Commit.closed < cutoff)))
+    (dbm.CommitFileDiff
+        .update(data=None)
+        .where((dbm.CommitFileDiff.commit << closed)
+            & ~(dbm.CommitFileDiff.data >> None))
+        .execute())
+
+def project_lock(project):
+
+    """ Returns the lock guarding a project's devel and stable checkouts """
+
+    with _project_locks_lock:
+        lock = _project_locks.get(project.id)
+        if lock is None:
+            lock = _project_locks[project.id] = threading.Lock()
+    return lock
+
+def get_poll(project, now):
+    try:
+        return dbm.ProjectPoll.get(project=project)
+    except dbm.ProjectPoll.DoesNotExist:
+        return dbm.ProjectPoll.create(project=project,
+            interval=POLL_MIN_INTERVAL, next_poll=now)
+
+def poll_project(project):
+
+    """ Fetches and ingests a project's tracked branches, but only
+    when their remote tips moved since the last poll. Idle projects
+    are probed less often, up to POLL_MAX_INTERVAL seconds apart. """
+
+    now = datetime.datetime.now()
+    poll = get_poll(project, now)
+    if poll.next_poll > now:
+        return False
+
+    branches = [b.name for b in project.branches]
+    try:
+        tips = project.git_control.get_remote_tips(branches)
+    except Exception as err:
+        logger.exception(err)
+        tips = None
+
+    if tips is not None and tips == poll.ref_tips:
+        poll.interval = min(poll.interval * 2, POLL_MAX_INTERVAL)
+    else:
+        updated = True
+        for branch in branches:
+            try:
+                with metrics.Timer() as timer:
+                    project.git_control.update_all(branch=branch)
+                    check_for_commits(project, branch=branch)
+                metrics.branch_seconds.observe(timer.seconds, 
+                    project=project.name, branch=branch)
+            except Exception as err:
+                # Git can sometimes reject pulls in larger projects
+                logger.exception(err)
+                updated = False
+        # Only remember the tips once they're ingested, so failures retry
+        if updated:
+            poll.ref_tips = tips
+        poll.interval = POLL_MIN_INTERVAL
+
+    poll.next_poll = now + datetime.timedelta(seconds=poll.interval)
+    poll.save()
+    return True
+
+def update_project(project):
+
+    """ Runs a single polling cycle for one project """
+
+    with project_lock(project), metrics.Timer() as timer:
+        poll_project(project)
+        try:
+            handle_approved(project)
+        except Exception as err:
+            logger.exception(err)
+    metrics.cycle_seconds.observe(timer.seconds, project=project.name)
+
+def prioritized_projects():
+
+    """ Returns all projects, those with approved commits waiting 
+    to be merged first """
+
+    approved = (dbm.Commit.select(dbm.Commit.project)
+        .where(dbm.Commit.status == 'approved')
+        .distinct()
+        .tuples())
+    approved_ids = set(row[0] for row in approved)
+    projects = list(dbm.Project.select().order_by(dbm.Project.id))
+    return sorted(projects, key=lambda p: p.id not in approved_ids)
+
+class DaemonHandler(metrics.MetricsHandler):
+
+    """ Serves the recent git commands at /trace as well as /metrics """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/trace':
+            return metrics.MetricsHandler.do_GET(self)
+        body = json.dumps({'commands': gittrace.recent()})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
 def start():
+    workers = getattr(ggconf, 'DAEMON_WORKERS', 1)
+    pool = None
+    dbm.create_tables(fail_silently=True)
+    try:
+        migrations.check_current()
+    except migrations.PendingMigrations as e:
+        logger.error('Not starting: %s', e)
+        sys.exit(1)
+    if workers > 1:
+        pool = ThreadPool(workers)
+    if DAEMON_METRICS_PORT:
+        metrics.serve(DAEMON_METRICS_HOST, DAEMON_METRICS_PORT, 
+            DaemonHandler)
+        logger.info('Serving metrics on %s:%d', DAEMON_METRICS_HOST, 
+            DAEMON_METRICS_PORT)
+    prerender = threading.Thread(target=prerender_worker, name='prerender')
+    prerender.daemon = True
+    prerender.start()
     running = True
     while running:
-        projects = dbm.Project.select()
-        for project in projects:
-            for branch in project.branches:
-                try:
-                    project.git_control.update_all(branch=branch.name)
-                    check_for_commits(project, branch=branch.name)
-                except Exception as err:
-                    # Git can sometimes reject pulls in larger projects
-                    logger.exception(err)
-            handle_approved(project)
-        time.sleep(10)
+        projects = prioritized_projects()
+        prune_diffs()
+        if pool:
+            # chunksize=1 hands projects out in priority order
+            pool.map(update_project, projects, chunksize=1)
+        else:
+            for project in projects:
+                update_project(project)
+        metrics.set_commit_counts(dbm.CommitCounter.totals(),
+            dict((p.id, p.name) for p in projects))
+        time.sleep(POLL_MIN_INTERVAL)
 
 def stop():
     running = False
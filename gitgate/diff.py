@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+"""
+Line diffs for the commit file view.
+
+Lines are interned to integers, common prefixes and suffixes are
+stripped, and the rest is aligned with patience diff: lines that appear
+exactly once on both sides anchor the alignment, and the gaps between
+anchors are diffed the same way. Gaps without any unique lines fall back
+to Myers' algorithm, bounded by max_edits. Once the time budget runs out
+the remaining gaps are shown as plain replacements, so the output is
+always a valid diff, just a less minimal one. Such a diff is marked
+degraded: it depends on how busy the machine was, so it shouldn't be
+cached or stored.
+"""
+import time
+
+DEFAULT_TIMEOUT = 2.0
+DEFAULT_MAX_EDITS = 500
+
+def intern_lines(to_lines, from_lines):
+
+    """ Maps both sides' lines to integers, equal lines to equal ids """
+
+    ids = {}
+    to_ids = [ids.setdefault(line, len(ids)) for line in to_lines]
+    from_ids = [ids.setdefault(line, len(ids)) for line in from_lines]
+    return to_ids, from_ids
+
+def unique_matches(a, alo, ahi, b, blo, bhi):
+
+    """ Returns (i, j) pairs of lines occurring exactly once in both
+    a[alo:ahi] and b[blo:bhi], ordered by i, keeping the longest run
+    with increasing j (patience sorting) """
+
+    counts = {}
+    for i in xrange(alo, ahi):
+        line = a[i]
+        if line in counts:
+            counts[line][0] += 1
+        else:
+            counts[line] = [1, i, 0, 0]
+    for j in xrange(blo, bhi):
+        entry = counts.get(b[j])
+        if entry:
+            entry[2] += 1
+            entry[3] = j
+    pairs = sorted((entry[1], entry[3]) for entry in counts.itervalues()
+        if entry[0] == 1 and entry[2] == 1)
+    if not pairs:
+        return []
+
+    # Longest increasing subsequence of j
+    tails = []
+    links = []
+    for i, j in pairs:
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if pairs[tails[mid]][1] < j:
+                lo = mid + 1
+            else:
+                hi = mid
+        links.append(tails[lo - 1] if lo else None)
+        if lo == len(tails):
+            tails.append(len(links) - 1)
+        else:
+            tails[lo] = len(links) - 1
+    result = []
+    k = tails[-1]
+    while k is not None:
+        result.append(pairs[k])
+        k = links[k]
+    result.reverse()
+    return result
+
+def myers_matches(a, alo, ahi, b, blo, bhi, max_edits):
+
+    """ Returns the matching (i, j) pairs of a shortest edit script
+    between the two ranges, or None if it needs more than max_edits """
+
+    n = ahi - alo
+    m = bhi - blo
+    limit = min(n + m, max_edits)
+    offset = limit + 1
+    v = [0] * (2 * limit + 3)
+    trace = []
+    for d in xrange(limit + 1):
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                trace.append(v[offset - d:offset + d + 1])
+                return _myers_backtrack(trace, alo, blo, n, m)
+        trace.append(v[offset - d:offset + d + 1])
+    return None
+
+def _myers_backtrack(trace, alo, blo, x, y):
+    matches = []
+    for d in xrange(len(trace) - 1, -1, -1):
+        k = x - y
+        if d == 0:
+            prev_x = prev_y = 0
+        else:
+            prev = trace[d - 1]
+            # prev holds diagonals -(d-1)..(d-1)
+            if k == -d or (k != d and prev[k - 1 + d - 1] < prev[k + 1 + d - 1]):
+                prev_k = k + 1
+            else:
+                prev_k = k - 1
+            prev_x = prev[prev_k + d - 1]
+            prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            matches.append((alo + x, blo + y))
+        if d > 0:
+            x, y = prev_x, prev_y
+    matches.reverse()
+    return matches
+
+def match_lines(a, b, timeout=DEFAULT_TIMEOUT, max_edits=DEFAULT_MAX_EDITS):
+
+    """ Returns (matches, degraded): the (i, j) pairs of matching lines
+    between a and b, and whether time ran out before every gap was 
+    aligned """
+
+    deadline = time.time() + timeout
+    degraded = False
+    matches = []
+    # Regions still to diff, and matches found ahead of them, in reverse
+    # order so the matches come out sorted
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        task = stack.pop()
+        if len(task) == 2:
+            matches.append(task)
+            continue
+        alo, ahi, blo, bhi = task
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        suffix = []
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            suffix.append((ahi, bhi))
+        stack.extend(suffix)
+        if alo == ahi or blo == bhi:
+            continue
+        if time.time() > deadline:
+            degraded = True
+            continue
+
+        anchors = unique_matches(a, alo, ahi, b, blo, bhi)
+        if not anchors:
+            found = myers_matches(a, alo, ahi, b, blo, bhi, max_edits)
+            if found:
+                stack.extend(reversed(found))
+            continue
+
+        # Gaps after each anchor, pushed last gap first
+        ends = anchors[1:] + [(ahi, bhi)]
+        for (i, j), (next_i, next_j) in reversed(zip(anchors, ends)):
+            stack.append((i + 1, next_i, j + 1, next_j))
+            stack.append((i, j))
+        stack.append((alo, anchors[0][0], blo, anchors[0][1]))
+    return matches, degraded
+
+def opcodes(a, b, timeout=DEFAULT_TIMEOUT, max_edits=DEFAULT_MAX_EDITS):
+
+    """ Returns (codes, degraded): difflib style (tag, i1, i2, j1, j2)
+    opcodes, and whether time ran out, see match_lines """
+
+    matches, degraded = match_lines(a, b, timeout, max_edits)
+    codes = []
+    i = j = 0
+    for mi, mj in matches + [(len(a), len(b))]:
+        if i < mi and j < mj:
+            codes.append(('replace', i, mi, j, mj))
+        elif i < mi:
+            codes.append(('delete', i, mi, j, mj))
+        elif j < mj:
+            codes.append(('insert', i, mi, j, mj))
+        if mi < len(a):
+            if codes and codes[-1][0] == 'equal':
+                tag, i1, i2, j1, j2 = codes.pop()
+                codes.append(('equal', i1, mi + 1, j1, mj + 1))
+            else:
+                codes.append(('equal', mi, mi + 1, mj, mj + 1))
+        i, j = mi + 1, mj + 1
+    return codes, degraded
+
+def grouped_opcodes(codes, n=3):
+
+    """ Splits opcodes into hunks with n lines of context, the same
+    way as difflib.SequenceMatcher.get_grouped_opcodes """
+
+    if not codes:
+        codes = [('equal', 0, 1, 0, 1)]
+    codes = list(codes)
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+def format_range(start, stop):
+    length = stop - start
+    if not length:
+        return '%d,0'%(start)
+    return '%d,%d'%(start + 1, length)
+
+def numbered_line(code, lnum, line):
+    if not line.endswith('\n'):
+        line += '\n'
+    return "%s%.4d: %s"%(code, lnum, line)
+
+class UnifiedDiff(object):
+
+    """ The lines of a unified diff, produced as they're iterated.
+    degraded is None until then, and afterwards True if time ran out 
+    and some changes are shown as plain replacements. """
+
+    def __init__(self, to_lines, from_lines, context=1, 
+            timeout=DEFAULT_TIMEOUT, max_edits=DEFAULT_MAX_EDITS):
+        self.to_lines = to_lines
+        self.from_lines = from_lines
+        self.context = context
+        self.timeout = timeout
+        self.max_edits = max_edits
+        self.degraded = None
+
+    def __iter__(self):
+        to_lines, from_lines = self.to_lines, self.from_lines
+        a, b = intern_lines(to_lines, from_lines)
+        codes, self.degraded = opcodes(a, b, self.timeout, self.max_edits)
+        for group in grouped_opcodes(codes, self.context):
+            first, last = group[0], group[-1]
+            yield "@@ -%s +%s @@\n"%(format_range(first[1], last[2]),
+                format_range(first[3], last[4]))
+            for tag, i1, i2, j1, j2 in group:
+                if tag == 'equal':
+                    for j in xrange(j1, j2):
+                        yield numbered_line(' ', j + 1, from_lines[j])
+                    continue
+                for i in xrange(i1, i2):
+                    yield numbered_line('-', i + 1, to_lines[i])
+                for j in xrange(j1, j2):
+                    yield numbered_line('+', j + 1, from_lines[j])
+
+def unified_diff(to_lines, from_lines, context=1, timeout=DEFAULT_TIMEOUT,
+        max_edits=DEFAULT_MAX_EDITS):
+
+    """ Returns the differences between to_lines and from_lines as a
+    UnifiedDiff of "@@ -a,b +c,d @@" hunk headers followed by lines of 
+    the form "<code><line number>: <line>", numbered by the side they 
+    come from """
+
+    return UnifiedDiff(to_lines, from_lines, context, timeout, max_edits)
+
+def render_html(lines):
+
+    """ Escapes and highlights lines from unified_diff one at a time """
+
+    empty = True
+    for line in lines:
+        empty = False
+        line = line.replace('&','&amp;')
+        line = line.replace('<','&lt;')
+        line = line.replace('>','&gt;')
+        if line.startswith('+'):
+            line = '<span class="code-line-added">%s</span>\n'%(line[:-1])
+        elif line.startswith('-'):
+            line = '<span class="code-line-removed">%s</span>\n'%(line[:-1])
+        yield line
+    if empty:
+        yield ("diff output: \"This commit's file changes "
+            "do not differ from stable\"")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Opt-in tracing of the git commands run through util.command, and of
+the objects read through util.GitObjectReader, turned on with GIT_TRACE.
+
+Each process keeps its last GIT_TRACE_SIZE commands in memory, with
+their working directory, duration, exit status and output size. Those
+taking GIT_SLOW_SECONDS or more are also appended to GIT_SLOW_LOG, one
+JSON object per line, which the daemon and web app share. The daemon's
+recent commands are served as JSON at /trace on DAEMON_METRICS_PORT,
+for the admin page and `gitgate site trace`.
+"""
+import collections
+import datetime
+import fcntl
+import json
+import os
+import threading
+import time
+import urllib2
+import ggconf
+
+GIT_TRACE = getattr(ggconf, 'GIT_TRACE', False)
+GIT_TRACE_SIZE = getattr(ggconf, 'GIT_TRACE_SIZE', 500)
+GIT_SLOW_SECONDS = getattr(ggconf, 'GIT_SLOW_SECONDS', 1.0)
+GIT_SLOW_LOG = getattr(ggconf, 'GIT_SLOW_LOG', os.path.join(
+    os.path.dirname(os.path.abspath(ggconf.DATABASE)), 'git-slow.log'))
+# The slow log is rotated to <GIT_SLOW_LOG>.1 past this size
+GIT_SLOW_LOG_BYTES = getattr(ggconf, 'GIT_SLOW_LOG_BYTES', 1024 * 1024)
+
+_recent = collections.deque(maxlen=GIT_TRACE_SIZE)
+_slow_lock = threading.Lock()
+
+def record(cmds, cwd, seconds, status, output_bytes):
+
+    """ Remembers a finished command, if tracing is on """
+
+    if not GIT_TRACE:
+        return
+    entry = {
+        'started': time.time() - seconds,
+        'command': list(cmds),
+        'cwd': cwd,
+        'seconds': round(seconds, 4),
+        'status': status,
+        'output_bytes': output_bytes,
+        'pid': os.getpid(),
+        'thread': threading.current_thread().name,
+    }
+    _recent.append(entry)
+    if GIT_SLOW_LOG and seconds >= GIT_SLOW_SECONDS:
+        log_slow(entry)
+
+def log_slow(entry):
+    line = json.dumps(entry) + '\n'
+    # The daemon and web app share the log, so it's rotated under a lock
+    # file both processes take, or one could rotate over the other's .1
+    with _slow_lock, open(GIT_SLOW_LOG + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.getsize(GIT_SLOW_LOG) + len(line) > GIT_SLOW_LOG_BYTES:
+                os.rename(GIT_SLOW_LOG, GIT_SLOW_LOG + '.1')
+        except OSError:
+            pass
+        with open(GIT_SLOW_LOG, 'a') as fh:
+            fh.write(line)
+
+def recent():
+
+    """ Returns this process' traced commands, newest first """
+
+    return list(reversed(_recent))
+
+def slow(limit=200):
+
+    """ Returns the last limit entries of the slow command log, newest
+    first """
+
+    entries = []
+    for path in [GIT_SLOW_LOG, GIT_SLOW_LOG + '.1']:
+        if not path or not os.path.exists(path):
+            continue
+        with open(path) as fh:
+            lines = fh.readlines()
+        for line in reversed(lines):
+            if len(entries) >= limit:
+                return entries
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # A line still being written by the other process
+                continue
+    return entries
+
+def daemon_recent(timeout=2):
+
+    """ Returns the daemon's traced commands, newest first, or None if
+    its HTTP server is off or can't be reached """
+
+    port = getattr(ggconf, 'DAEMON_METRICS_PORT', 0)
+    if not port:
+        return None
+    url = 'http://%s:%d/trace'%(
+        getattr(ggconf, 'DAEMON_METRICS_HOST', '127.0.0.1'), port)
+    try:
+        return json.load(urllib2.urlopen(url, timeout=timeout))['commands']
+    except (IOError, ValueError, KeyError):
+        return None
+
+def format_entry(entry):
+
+    """ Returns a line of text describing a traced command """
+
+    started = datetime.datetime.fromtimestamp(entry['started'])
+    return '%s %8.3fs exit %-3s %10d bytes  %s  (%s)'%(
+        started.strftime('%Y-%m-%d %H:%M:%S'), entry['seconds'],
+        entry['status'], entry['output_bytes'], ' '.join(entry['command']),
+        entry['cwd'])
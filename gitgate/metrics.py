@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+Counters, gauges and histograms for the daemon and web app, exposed in
+Prometheus' text format: by the web app at /metrics, and by the daemon
+on DAEMON_METRICS_PORT.
+
+Each process keeps its own metrics in memory; nothing is shared between
+them or kept across restarts.
+"""
+import BaseHTTPServer
+import threading
+import time
+import profiler
+
+# Seconds, for requests, git commands and queries
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+# Seconds, for daemon cycles
+SLOW_BUCKETS = (.1, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Queries per request
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_metrics = []
+_local = threading.local()
+
+def escape(value):
+    return unicode(value).replace('\\', r'\\').replace('\n', r'\n'
+        ).replace('"', r'\"')
+
+def format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}'%(','.join('%s="%s"'%(name, escape(value))
+        for name, value in pairs))
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(object):
+
+    """ A named metric with a value per combination of label values """
+
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+
+        """ Yields (suffix, label values, extra labels, value) """
+
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield '', key, (), value
+
+    def render(self):
+        lines = ['# HELP %s %s'%(self.name, self.description),
+            '# TYPE %s %s'%(self.name, self.kind)]
+        for suffix, key, extra, value in self.samples():
+            lines.append('%s%s%s %s'%(self.name, suffix,
+                format_labels(self.labels, key, extra), format_value(value)))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def replace(self, values):
+
+        """ Sets every value at once from {label values: value},
+        dropping those not given """
+
+        with self.lock:
+            self.values = dict(values)
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(),
+            buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key,
+                ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = counts, total + value
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, (list(counts), total))
+                for key, (counts, total) in self.values.items())
+        for key, (counts, total) in items:
+            for bound, count in zip(self.buckets, counts):
+                yield '_bucket', key, [('le', format_value(bound))], count
+            yield '_sum', key, (), total
+            yield '_count', key, (), counts[-1]
+
+def render():
+
+    """ Returns every metric in Prometheus' text format """
+
+    return '\n'.join(m.render() for m in _metrics) + '\n'
+
+### ----------------------------------------------------------------------------
+### Metrics
+### ----------------------------------------------------------------------------
+
+git_seconds = Histogram('gitgate_git_command_seconds',
+    'Time spent running git commands', ['command'])
+db_queries = Counter('gitgate_db_queries_total', 'SQL statements run')
+db_query_seconds = Histogram('gitgate_db_query_seconds',
+    'Time spent executing SQL statements')
+commits = Gauge('gitgate_commits',
+    'Commits by project and status', ['project', 'status'])
+
+request_seconds = Histogram('gitgate_http_request_seconds',
+    'Time taken to answer web requests', ['endpoint', 'method'])
+request_queries = Histogram('gitgate_http_request_queries',
+    'SQL statements run per web request', ['endpoint'], COUNT_BUCKETS)
+
+cycle_seconds = Histogram('gitgate_daemon_cycle_seconds',
+    'Time taken by a polling cycle of a project', ['project'],
+    SLOW_BUCKETS)
+branch_seconds = Histogram('gitgate_daemon_branch_update_seconds',
+    'Time taken fetching and ingesting a branch', ['project', 'branch'],
+    SLOW_BUCKETS)
+commits_ingested = Counter('gitgate_daemon_commits_ingested_total',
+    'Commits recorded from the development repository',
+    ['project', 'branch'])
+merge_batches = Counter('gitgate_daemon_merge_batches_total',
+    'Batches of approved commits pushed to stable, or rolled back',
+    ['project', 'branch', 'result'])
+commits_merged = Counter('gitgate_daemon_commits_merged_total',
+    'Commits merged into stable', ['project', 'branch'])
+
+### ----------------------------------------------------------------------------
+### Helpers
+### ----------------------------------------------------------------------------
+
+def command_name(cmds):
+
+    """ Returns the git subcommand of a command line, or the program """
+
+    program = cmds[0].rsplit('/', 1)[-1]
+    if program == 'git' and len(cmds) > 1:
+        return cmds[1]
+    return program
+
+def observe_git(cmds, seconds):
+    git_seconds.observe(seconds, command=command_name(cmds))
+    profiler.add('git', seconds)
+
+def observe_query(seconds):
+    db_queries.inc()
+    db_query_seconds.observe(seconds)
+    profiler.add('sql', seconds)
+    _local.queries = getattr(_local, 'queries', 0) + 1
+
+def observe_fetch(seconds):
+
+    """ Counts time spent fetching a statement's rows towards the
+    profile's sql section, without counting another statement """
+
+    profiler.add('sql', seconds, calls=0)
+
+def reset_queries():
+
+    """ Starts counting the current thread's queries from zero,
+    returning the count so far """
+
+    count = getattr(_local, 'queries', 0)
+    _local.queries = 0
+    return count
+
+def set_commit_counts(totals, names):
+
+    """ Sets the commits gauge from CommitCounter.totals(), with names
+    mapping project ids to names """
+
+    values = {}
+    for project_id, statuses in totals.items():
+        for status, (count, oldest) in statuses.items():
+            values[(names.get(project_id, project_id), status)] = count
+    commits.replace(values)
+
+class Timer(object):
+
+    """ Measures the time taken by a with block, in seconds """
+
+    def __enter__(self):
+        self.start = time.time()
+        self.seconds = None
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.time() - self.start
+
+### ----------------------------------------------------------------------------
+### Daemon HTTP server
+### ----------------------------------------------------------------------------
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(host, port, handler=MetricsHandler):
+
+    """ Serves /metrics from a background thread, returning the server """
+
+    server = BaseHTTPServer.HTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever,
+        name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
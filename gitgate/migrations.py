@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+Schema changes for sites created by older versions of GitGate, applied
+with `gitgate site migrate`.
+
+The schema version lives in SQLite's user_version pragma. Each migration
+runs in its own transaction along with the version bump, so the daemon
+and web app can stay up while it runs; at worst they wait on the lock
+while an index is built. Migrations must be safe to re-run against a
+database that already has some of their changes.
+"""
+import datetime
+import models as md
+
+MIGRATIONS = []
+
+class PendingMigrations(Exception):
+
+    """ The database is older than the code, see check_current """
+
+def migration(version, description):
+
+    """ Registers fn as the migration to schema version <version> """
+
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort()
+        return fn
+    return register
+
+def current_version():
+    return md.database.execute_sql('PRAGMA user_version').fetchone()[0]
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def set_version(version):
+    md.database.execute_sql('PRAGMA user_version = %d'%(int(version)))
+
+def pending():
+
+    """ Returns the (version, description, fn) migrations not yet
+    applied, in order """
+
+    version = current_version()
+    return [m for m in MIGRATIONS if m[0] > version]
+
+def check_current():
+
+    """ Raises PendingMigrations if any migrations are pending. The
+    daemon and web app check at startup, since the models expect the
+    latest schema. """
+
+    waiting = pending()
+    if waiting:
+        raise PendingMigrations('%d database migration(s) pending, run '
+            '"gitgate site migrate" to apply them'%(len(waiting)))
+
+def add_index(model, fields, unique=False):
+
+    """ Creates an index on model's fields unless it exists, named the
+    way peewee names the indexes it creates for new sites """
+
+    table = model._meta.db_table
+    columns = [model._meta.fields[name].db_column for name in fields]
+    name = md.database.compiler().index_name(table, columns)
+    md.database.execute_sql('CREATE %sINDEX IF NOT EXISTS "%s" ON "%s" (%s)'%(
+        'UNIQUE ' if unique else '', name, table,
+        ', '.join('"%s"'%(c) for c in columns)))
+
+@migration(1, 'Poll state and pre-rendered diff tables')
+def create_poll_and_diff_tables():
+    md.ProjectPoll.create_table(fail_silently=True)
+    md.CommitFileDiff.create_table(fail_silently=True)
+
+@migration(2, 'Indexes for commit listings, file conflicts, logs and roles')
+def add_query_indexes():
+    add_index(md.CommitFile, ['file_path'])
+    add_index(md.Commit, ['status'])
+    add_index(md.Commit, ['author_date'])
+    add_index(md.Commit, ['project', 'author_date'])
+    add_index(md.Commit, ['project', 'status', 'author_date'])
+    add_index(md.CommitLog, ['commit'])
+    add_index(md.ProjectRole, ['user', 'project', 'role'])
+    md.database.execute_sql('ANALYZE')
+
+@migration(3, 'Commit counts per project, branch and status')
+def create_commit_counters():
+    md.CommitCounter.create_table(fail_silently=True)
+    md.CommitCounter.rebuild()
+
+@migration(4, 'Full text search of commit messages, authors and paths')
+def create_commit_search():
+    if md.CommitSearch.create_table():
+        md.CommitSearch.rebuild()
+    else:
+        print("SQLite was built without FTS5, commit search is disabled")
+
+@migration(5, 'Interned file paths for file and directory histories')
+def create_path_index():
+    md.PathDir.create_table(fail_silently=True)
+    md.FilePath.create_table(fail_silently=True)
+    md.CommitPath.create_table(fail_silently=True)
+    md.CommitPath.rebuild()
+
+@migration(6, 'When commits were closed, for diff retention')
+def add_commit_closed():
+    columns = [row[1] for row in
+        md.database.execute_sql('PRAGMA table_info("commit")')]
+    if 'closed' not in columns:
+        md.database.execute_sql(
+            'ALTER TABLE "commit" ADD COLUMN "closed" DATETIME')
+    # Commits closed before now keep their diffs for the full retention
+    # period from here
+    (md.Commit
+        .update(closed=datetime.datetime.now())
+        .where((md.Commit.closed >> None)
+            & (md.Commit.status << list(md.Commit.CLOSED_STATUSES)))
+        .execute())
+
+def known_queries():
+
+    """ Returns (name, query) pairs for the queries the daemon and web
+    app run most, with placeholder ids """
+
+    Commit, CommitFile = md.Commit, md.CommitFile
+    pending_statuses = ((Commit.status != 'merged')
+        & (Commit.status != 'rejected')
+        & (Commit.status != 'outdated'))
+    return [
+        ('commits listing', Commit.select()
+            .where(Commit.project == 1)
+            .order_by(Commit.author_date.desc(), Commit.id.desc())
+            .limit(51)),
+        ('commits listing by status', Commit.select()
+            .where((Commit.project == 1)
+                & (Commit.status << ['reviewed', 'approved']))
+            .order_by(Commit.author_date.desc(), Commit.id.desc())
+            .limit(51)),
+        ('projects with approved commits', Commit
+            .select(Commit.project)
+            .where(Commit.status == 'approved')
+            .distinct()),
+        ('older commits touching the same files', CommitFile.select()
+            .join(Commit)
+            .where((Commit.project == 1) & pending_statuses
+                & (Commit.author_date < datetime.datetime.now())
+                & (CommitFile.file_path << (CommitFile
+                    .select(CommitFile.file_path)
+                    .where(CommitFile.commit == 1))))),
+        ('file history', md.CommitPath
+            .select(md.CommitPath.commit, Commit)
+            .join(Commit, md.JOIN.CROSS)
+            .where((md.CommitPath.commit == Commit.id)
+                & (md.CommitPath.file << md.CommitPath.files('src'))
+                & (Commit.project == 1))
+            .distinct()
+            .order_by(md.CommitPath.commit.desc())
+            .limit(51)),
+        ('commit log', md.CommitLog.select()
+            .where(md.CommitLog.commit == 1)),
+        ('project role check', md.ProjectRole.select()
+            .where((md.ProjectRole.user == 1)
+                & (md.ProjectRole.project == 1)
+                & (md.ProjectRole.role == 1))),
+    ]
+
+def explain():
+
+    """ Returns {name: [plan lines]} for the known queries, or the 
+    error for those that can't run yet, such as against a table a
+    pending migration creates """
+
+    plans = {}
+    for name, query in known_queries():
+        sql, params = query.sql()
+        try:
+            rows = md.database.execute_sql('EXPLAIN QUERY PLAN ' + sql, 
+                params)
+        except md.OperationalError as err:
+            plans[name] = ['(%s)'%(err)]
+            continue
+        plans[name] = [row[-1] for row in rows]
+    return plans
+
+def migrate(report=True):
+
+    """ Applies the pending migrations in order. With report, prints
+    each step and the query plans of the known queries before and
+    after. Returns the migrations applied. """
+
+    applied = pending()
+    if not applied:
+        if report:
+            print("Database is up to date (version %d)"%(current_version()))
+        return applied
+
+    before = explain()
+    for version, description, fn in applied:
+        if report:
+            print("Migrating to version %d: %s"%(version, description))
+        with md.database.transaction():
+            fn()
+            set_version(version)
+
+    if report:
+        after = explain()
+        for name, query in known_queries():
+            print("\n%s"%(name))
+            if before[name] == after[name]:
+                for line in after[name]:
+                    print("    %s"%(line))
+                continue
+            for line in before[name]:
+                print("  - %s"%(line))
+            for line in after[name]:
+                print("  + %s"%(line))
+    return applied
@@ -1,19 +1,117 @@
 from peewee import *
+import collections
+import re
+import zlib
 import util
 import datetime
+import metrics
+import profiler
+import time
 import ggconf
 
-database = SqliteDatabase(ggconf.DATABASE)
+# WAL lets the web app keep reading while the daemon writes, and
+# busy_timeout makes writers wait on each other instead of failing with
+# "database is locked"
+DATABASE_PRAGMAS = getattr(ggconf, 'DATABASE_PRAGMAS', [
+    ('journal_mode', 'wal'),
+    ('busy_timeout', 5000),
+    ('synchronous', 'normal'),
+    ('cache_size', -8000),
+])
+DATABASE_POOL_SIZE = getattr(ggconf, 'DATABASE_POOL_SIZE', 0)
+DATABASE_POOL_STALE = getattr(ggconf, 'DATABASE_POOL_STALE', 300)
 
-def create_tables():
-    User.create_table()
-    Role.create_table()
-    Project.create_table()
-    ProjectBranch.create_table()
-    ProjectRole.create_table()
-    Commit.create_table()
-    CommitFile.create_table()
-    CommitLog.create_table()
+class TimedCursor(object):
+
+    """ Wraps a cursor to time fetching its rows. SQLite finds rows as
+    they're fetched, so for a query iterated by a template or route
+    that's where most of its time goes. """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def timed(self, fetch, *args):
+        start = time.time()
+        try:
+            return fetch(*args)
+        finally:
+            metrics.observe_fetch(time.time() - start)
+
+    def fetchone(self):
+        return self.timed(self.cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self.timed(self.cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self.timed(self.cursor.fetchall)
+
+class TimedQueries(object):
+
+    """ Records how many statements run and how long they take, see
+    metrics. While a request is profiled, fetching rows is timed too. """
+
+    def execute_sql(self, *args, **kwargs):
+        start = time.time()
+        try:
+            cursor = super(TimedQueries, self).execute_sql(*args, **kwargs)
+        finally:
+            metrics.observe_query(time.time() - start)
+        if profiler.current() is not None:
+            cursor = TimedCursor(cursor)
+        return cursor
+
+class GitGateDatabase(TimedQueries, SqliteDatabase):
+    pass
+
+# The daemon polls projects from several threads, so each thread
+# needs its own connection
+if DATABASE_POOL_SIZE:
+    # Pooled connections are handed to one thread at a time, but not
+    # always the thread that opened them
+    from playhouse.pool import PooledSqliteDatabase
+
+    class PooledGitGateDatabase(TimedQueries, PooledSqliteDatabase):
+        pass
+
+    database = PooledGitGateDatabase(ggconf.DATABASE, 
+        pragmas=list(DATABASE_PRAGMAS), max_connections=DATABASE_POOL_SIZE,
+        stale_timeout=DATABASE_POOL_STALE, threadlocals=True,
+        check_same_thread=False)
+else:
+    database = GitGateDatabase(ggconf.DATABASE, 
+        pragmas=list(DATABASE_PRAGMAS), threadlocals=True)
+
+def write_transaction():
+
+    """ A transaction that takes the write lock up front, so it waits
+    out other writers for busy_timeout rather than failing when a read
+    has to be upgraded to a write """
+
+    return database.transaction('IMMEDIATE')
+
+def create_tables(fail_silently=False):
+    User.create_table(fail_silently)
+    Role.create_table(fail_silently)
+    Project.create_table(fail_silently)
+    ProjectBranch.create_table(fail_silently)
+    ProjectRole.create_table(fail_silently)
+    Commit.create_table(fail_silently)
+    CommitFile.create_table(fail_silently)
+    PathDir.create_table(fail_silently)
+    FilePath.create_table(fail_silently)
+    CommitPath.create_table(fail_silently)
+    CommitLog.create_table(fail_silently)
+    ProjectPoll.create_table(fail_silently)
+    CommitFileDiff.create_table(fail_silently)
+    CommitCounter.create_table(fail_silently)
+    CommitSearch.create_table()
 
 def populate_data():
     Role.create(name='reviewer')
@@ -29,6 +127,28 @@ class User(DBModel):
     name = CharField()
     password = CharField()
     is_admin = BooleanField(default=False)
+    _project_roles = None
+
+    @property
+    def project_roles(self):
+
+        """ Maps project ids to the ids of this user's roles in them,
+        loaded with one query the first time it's needed """
+
+        if self._project_roles is not None:
+            return self._project_roles
+        roles = {}
+        rows = (ProjectRole
+            .select(ProjectRole.project, ProjectRole.role)
+            .where(ProjectRole.user == self)
+            .tuples())
+        for project_id, role_id in rows:
+            roles.setdefault(project_id, set()).add(role_id)
+        self._project_roles = roles
+        return roles
+
+    def clear_project_roles(self):
+        self._project_roles = None
     
     def has_project_role(self, project, role):
         if role == 'admin':
@@ -38,12 +158,10 @@ class User(DBModel):
             return True
 
         if isinstance(role, str) or isinstance(role, unicode):
-            role = Role.get(name=role)
-        try:
-            ProjectRole.get(user=self, role=role, project=project)
-            return True
-        except:
-            return False
+            role = Role.cached(role)
+        role_id = getattr(role, 'id', role)
+        project_id = getattr(project, 'id', project)
+        return role_id in self.project_roles.get(project_id, ())
 
 class Project(DBModel):
 
@@ -61,6 +179,16 @@ class Project(DBModel):
         self._git_control = util.GitProject(self)
         return self._git_control
 
+class ProjectPoll(DBModel):
+
+    """ The remote branch tips seen on the last poll of a project,
+    and when the daemon should look again """
+
+    project = ForeignKeyField(Project, related_name='polls', unique=True)
+    ref_tips = TextField(default=None, null=True)
+    interval = IntegerField(default=10)
+    next_poll = DateTimeField(default=datetime.datetime.now)
+
 class ProjectBranch(DBModel):
 
     name = CharField()
@@ -78,6 +206,22 @@ class Role(DBModel):
 
     name = CharField(unique=True)
     description = TextField(default=None, null=True)
+    _cache = {}
+
+    @classmethod
+    def cached(cls, name):
+
+        """ Returns the role called name, kept for the life of the
+        process since roles are only created along with the site """
+
+        role = cls._cache.get(name)
+        if role is None:
+            role = cls._cache[name] = cls.get(name=name)
+        return role
+
+    @classmethod
+    def clear_cache(cls):
+        cls._cache.clear()
 
 class ProjectRole(DBModel):
 
@@ -85,6 +229,21 @@ class ProjectRole(DBModel):
     project = ForeignKeyField(Project, related_name='roles')
     role = ForeignKeyField(Role)
 
+    class Meta:
+        indexes = (
+            (('user', 'project', 'role'), False),
+        )
+
+class ActionError(Exception):
+
+    """ A review action that isn't allowed. code is the HTTP status 
+    to answer with, 403 for missing roles and 400 otherwise. """
+
+    def __init__(self, message, code=400):
+        Exception.__init__(self, message)
+        self.message = message
+        self.code = code
+
 class Commit(DBModel):
 
     STATUSES = (
@@ -100,29 +259,193 @@ class Commit(DBModel):
     sha1 = CharField(unique=True)
     branch = CharField()
     project = ForeignKeyField(Project, related_name='commits')
-    author_date = DateTimeField()
+    author_date = DateTimeField(index=True)
     author_name = CharField()
     author_email = CharField()
     message = TextField()
-    status = CharField(choices=STATUSES)
+    status = CharField(choices=STATUSES, index=True)
+    # When the commit was last merged, outdated or rejected
+    closed = DateTimeField(null=True)
+
+    CLOSED_STATUSES = ('merged', 'outdated', 'rejected')
+    PENDING_STATUSES = tuple([s[0] for s in STATUSES 
+        if s[0] not in CLOSED_STATUSES])
+
+    class Meta:
+        indexes = (
+            # The commits listing, unfiltered and filtered by status
+            (('project', 'author_date'), False),
+            (('project', 'status', 'author_date'), False),
+        )
+
+    def save(self, *args, **kwargs):
+
+        """ Saves the commit, moving it between CommitCounter rows in
+        the same transaction when it's new or its status changed, and
+        stamping closed when it's merged, outdated or rejected """
+
+        with write_transaction():
+            old_status = None
+            if self.id is not None:
+                old_status = (Commit.select(Commit.status)
+                    .where(Commit.id == self.id)
+                    .scalar())
+            if old_status != self.status:
+                self.closed = (datetime.datetime.now() 
+                    if self.status in self.CLOSED_STATUSES else None)
+            result = super(Commit, self).save(*args, **kwargs)
+            if old_status != self.status:
+                CommitCounter.move(self, old_status, self.status)
+                if old_status is not None:
+                    CommitSearch.set_status(self)
+        return result
+
+    @classmethod
+    def page(cls, project, statuses=None, limit=50, before=None, after=None,
+            path=None):
+
+        """ Returns a page of a project's commits, newest first, with
+        keyset pagination: before and after are the ids of the last and
+        first commits of the neighbouring page. Returns (commits, 
+        has_newer, has_older) from a single query.
+
+        With path, only the commits touching that file or directory, 
+        most recently recorded first. That query starts from the path
+        index and pages by commit id, so it reads the path's commits 
+        rather than every commit of the project. """
+
+        if path:
+            # A cross join makes SQLite start from the path's rows rather 
+            # than the project's commits
+            query = (CommitPath
+                .select(CommitPath.commit, cls)
+                .join(cls, JOIN.CROSS)
+                .where((CommitPath.commit == cls.id)
+                    & (CommitPath.file << CommitPath.files(path)))
+                .distinct())
+        else:
+            query = cls.select()
+        query = query.where(cls.project == project)
+        if statuses and set(statuses) != set(s[0] for s in cls.STATUSES):
+            query = query.where(cls.status << statuses)
+
+        if path:
+            key = CommitPath.commit
+            if before:
+                query = query.where(key < before).order_by(key.desc())
+            elif after:
+                query = query.where(key > after).order_by(key.asc())
+            else:
+                query = query.order_by(key.desc())
+        elif before or after:
+            cursor_date = (cls.select(cls.author_date)
+                .where(cls.id == (before or after)))
+            if before:
+                query = (query
+                    .where((cls.author_date <= cursor_date) & 
+                        ((cls.author_date < cursor_date) | (cls.id < before)))
+                    .order_by(cls.author_date.desc(), cls.id.desc()))
+            else:
+                query = (query
+                    .where((cls.author_date >= cursor_date) & 
+                        ((cls.author_date > cursor_date) | (cls.id > after)))
+                    .order_by(cls.author_date.asc(), cls.id.asc()))
+        else:
+            query = query.order_by(cls.author_date.desc(), cls.id.desc())
+
+        commits = list(query.limit(limit + 1))
+        if path:
+            commits = [row.commit for row in commits]
+        more = len(commits) > limit
+        commits = commits[:limit]
+        if after:
+            commits.reverse()
+            return commits, more, True
+        return commits, bool(before), more
+
+    @classmethod
+    def existing_sha1s(cls, sha1s, chunk_size=500):
+
+        """ Returns the set of sha1s that are already recorded, looked 
+        up in chunks against the unique sha1 index """
+
+        found = set()
+        for i in range(0, len(sha1s), chunk_size):
+            rows = (cls.select(cls.sha1)
+                .where(cls.sha1 << sha1s[i:i + chunk_size])
+                .tuples())
+            found.update(row[0] for row in rows)
+        return found
 
     @property
     def can_merge(self):
-        _merge = True
-        older_commits = (self
+
+        """ True once no older pending commit in this project
+        touches any of this commit's files """
+
+        this_files = (CommitFile
+            .select(CommitFile.file_path)
+            .where(CommitFile.commit == self))
+        blocking = (CommitFile
             .select()
-            .where((Commit.status != 'merged') 
+            .join(Commit)
+            .where((Commit.project == self.project)
+                & (Commit.status != 'merged') 
                 & (Commit.status != 'rejected')
                 & (Commit.status != 'outdated')
-                & (Commit.author_date < self.author_date))
-        )
-        this_files = [f.file_path for f in self.files]
-        for cm in older_commits:
-            for f in cm.files:
-                if f.file_path in this_files:
-                    _merge = False
-                    break
-        return _merge
+                & (Commit.author_date < self.author_date)
+                & (CommitFile.file_path << this_files)))
+        return not blocking.exists()
+
+    ACTIONS = ('approve', 'review', 'reject', 'unreject', 'comment')
+
+    def apply_action(self, user, action, message=None):
+
+        """ Applies a review action on behalf of user, checking the
+        commit's status and the user's project roles first. Raises
+        ActionError if the action isn't allowed. """
+
+        if action == 'approve':
+            if self.status not in ['reviewed','committed']:
+                raise ActionError('Commit must be committed or reviewed '
+                    'to approve')
+            if not user.has_project_role(self.project_id, 'approver'):
+                raise ActionError('You need the project role approver '
+                    'to do that', 403)
+            new_status, log = 'approved', 'Approved'
+
+        elif action == 'review':
+            if not user.has_project_role(self.project_id, 'reviewer'):
+                raise ActionError('You need the project role reviewer '
+                    'to do that', 403)
+            if self.status not in ['committed']:
+                raise ActionError('Commit must be committed to review')
+            new_status, log = 'reviewed', 'Reviewed'
+
+        elif action == 'reject':
+            if self.status not in ['committed','reviewed','approved']:
+                raise ActionError('Commit cannot be merged to reject')
+            new_status, log = 'rejected', 'Rejected'
+
+        elif action == 'unreject':
+            if self.status not in ['rejected']:
+                raise ActionError('Commit must be rejected to unreject')
+            new_status, log = 'committed', None
+
+        elif action == 'comment':
+            if not message:
+                raise ActionError('Comment cannot be blank')
+            new_status, log = self.status, message
+
+        else:
+            raise ActionError('Unknown action %s'%(action), 404)
+
+        with write_transaction():
+            if new_status != self.status:
+                self.status = new_status
+                self.save()
+            if log:
+                CommitLog.create(user=user, commit=self, message=log)
 
     def clone(self, new_sha1, new_author_date=None, new_status='committed', 
             clone_files=True):
@@ -144,11 +467,8 @@ class Commit(DBModel):
 
         if clone_files:
             # Copy the files to the new commit
-            for cf in self.files:
-                new_cf = CommitFile.create(
-                    commit=new_commit, 
-                    file_path=cf.file_path,
-                    change_type=cf.change_type)
+            CommitFile.bulk_create(new_commit, 
+                [[cf.change_type, cf.file_path] for cf in self.files])
 
         # Add a log message
         log = CommitLog.create(
@@ -162,15 +482,488 @@ class Commit(DBModel):
 class CommitFile(DBModel):
     
     commit = ForeignKeyField(Commit, related_name='files')
-    file_path = CharField()
+    file_path = CharField(index=True)
     change_type = CharField(choices=['A','M','D'])
     
     class Meta:
         primary_key = CompositeKey('commit', 'file_path')
 
+    @classmethod
+    def bulk_create(cls, commit, file_changes, chunk_size=300):
+
+        """ Inserts [STATUS, FILENAME] changes for a commit, a few 
+        hundred rows per statement to stay under SQLite's variable limit """
+
+        rows = [{'commit':commit, 'change_type':status, 'file_path':fpath}
+            for status, fpath in file_changes]
+        for i in range(0, len(rows), chunk_size):
+            cls.insert_many(rows[i:i + chunk_size]).execute()
+        CommitPath.add(commit, [fpath for status, fpath in file_changes])
+
+    @staticmethod
+    def prefix_bounds(prefix):
+
+        """ Returns (low, high) such that the paths starting with prefix
+        are those with low <= path < high, a range the file_path
+        indexes can answer, unlike LIKE """
+
+        return prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+    @classmethod
+    def path_starts_with(cls, prefix):
+        low, high = cls.prefix_bounds(prefix)
+        return (cls.file_path >= low) & (cls.file_path < high)
+
+class PathDir(DBModel):
+
+    """ A directory, stored once however many files and commits share
+    it. The top level directory is the empty string. """
+
+    path = CharField(unique=True)
+
+class FilePath(DBModel):
+
+    """ A file path, interned as its directory and name """
+
+    directory = ForeignKeyField(PathDir, related_name='files')
+    name = CharField()
+
+    class Meta:
+        indexes = (
+            (('directory', 'name'), True),
+        )
+
+    @staticmethod
+    def split(fpath):
+
+        """ Returns (directory, name) for a path """
+
+        directory, _, name = fpath.strip('/').rpartition('/')
+        return directory, name
+
+    @classmethod
+    def intern(cls, paths, chunk_size=300):
+
+        """ Returns {path: FilePath id} for paths, adding the paths and 
+        directories not seen before """
+
+        split = dict((fpath, cls.split(fpath)) for fpath in set(paths))
+        dirs = sorted(set(d for d, name in split.itervalues()))
+        dir_ids = {}
+        for rows in [dirs[i:i + chunk_size] 
+                for i in range(0, len(dirs), chunk_size)]:
+            PathDir.insert_many([{'path': d} for d in rows]
+                ).on_conflict('IGNORE').execute()
+            dir_ids.update(PathDir.select(PathDir.path, PathDir.id)
+                .where(PathDir.path << rows).tuples())
+
+        files = sorted(set((dir_ids[d], name) 
+            for d, name in split.itervalues()))
+        file_ids = {}
+        # Two variables a row
+        chunk_size //= 2
+        for rows in [files[i:i + chunk_size]
+                for i in range(0, len(files), chunk_size)]:
+            cls.insert_many([{'directory': d, 'name': name} 
+                for d, name in rows]).on_conflict('IGNORE').execute()
+            file_ids.update(((d, name), fid) for fid, d, name in cls
+                .select(cls.id, cls.directory, cls.name)
+                .where((cls.directory << list(set(d for d, n in rows)))
+                    & (cls.name << list(set(n for d, n in rows))))
+                .tuples())
+
+        return dict((fpath, file_ids[(dir_ids[d], name)]) 
+            for fpath, (d, name) in split.iteritems())
+
+class CommitPath(DBModel):
+
+    """ The files each commit touched, by interned path. Unlike 
+    CommitFile it's keyed by file first, so a file's or directory's 
+    history is a range scan. """
+
+    file = ForeignKeyField(FilePath, related_name='commits')
+    commit = ForeignKeyField(Commit, related_name='paths')
+
+    class Meta:
+        primary_key = CompositeKey('file', 'commit')
+
+    @classmethod
+    def add(cls, commit, paths, chunk_size=300):
+        file_ids = FilePath.intern(paths).values()
+        commit_id = getattr(commit, 'id', commit)
+        for i in range(0, len(file_ids), chunk_size):
+            cls.insert_many([{'file': fid, 'commit': commit_id} 
+                for fid in file_ids[i:i + chunk_size]]
+                ).on_conflict('IGNORE').execute()
+
+    @classmethod
+    def files(cls, path):
+
+        """ Returns a query of the ids of the file at path, or of every
+        file under it if it's a directory """
+
+        path = path.strip('/')
+        directory, name = FilePath.split(path)
+        dirs = (PathDir.select(PathDir.id)
+            .where((PathDir.path == path) | ((PathDir.path > path + '/')
+                & (PathDir.path < path + '0'))))
+        exact = (FilePath.select(FilePath.id)
+            .join(PathDir)
+            .where((PathDir.path == directory) & (FilePath.name == name)))
+        return exact | FilePath.select(FilePath.id).where(
+            FilePath.directory << dirs)
+
+    @classmethod
+    def rebuild(cls, chunk_size=300):
+
+        """ Indexes every commit's files from CommitFile """
+
+        with write_transaction():
+            cls.delete().execute()
+            file_ids = FilePath.intern(row[0] for row in CommitFile
+                .select(CommitFile.file_path).distinct().tuples())
+            rows = CommitFile.select(CommitFile.commit, 
+                CommitFile.file_path).tuples()
+            batch = []
+            for commit_id, fpath in rows.iterator():
+                batch.append({'file': file_ids[fpath], 'commit': commit_id})
+                if len(batch) >= chunk_size:
+                    cls.insert_many(batch).execute()
+                    batch = []
+            if batch:
+                cls.insert_many(batch).execute()
+
+class CommitFileDiff(DBModel):
+
+    """ A file diff rendered by the daemon when its commit came in.
+    diff_key is GitProject.get_diff_key at the time, data the zlib 
+    compressed HTML, or None when it was too large to keep. A diff that
+    failed to render is stored with the FAILED diff_key and no counts,
+    so it isn't retried every cycle. """
+
+    FAILED = 'failed'
+
+    commit = ForeignKeyField(Commit, related_name='diffs')
+    file_path = CharField()
+    diff_key = CharField()
+    data = BlobField(null=True)
+    added = IntegerField(default=0)
+    removed = IntegerField(default=0)
+    created = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        primary_key = CompositeKey('commit', 'file_path')
+
+    @classmethod
+    def get_rendered(cls, commit, file_path, diff_key):
+
+        """ Returns the stored HTML if it's still current, or None """
+
+        try:
+            stored = cls.get(commit=commit, file_path=file_path, 
+                diff_key=diff_key)
+        except cls.DoesNotExist:
+            return None
+        if stored.data is None:
+            return None
+        return zlib.decompress(str(stored.data))
+
 class CommitLog(DBModel):
     
     commit = ForeignKeyField(Commit, related_name='logs')
     user = ForeignKeyField(User, null=True, default=None)
     created = DateTimeField(default=datetime.datetime.now)
     message = TextField()    
+
+class CommitCounter(DBModel):
+
+    """ How many of a project branch's commits have each status, and
+    the author date of the oldest of them. Kept up to date by 
+    Commit.save, so dashboards don't have to count the commits table. """
+
+    project = ForeignKeyField(Project, related_name='counters')
+    branch = CharField()
+    status = CharField()
+    count = IntegerField(default=0)
+    oldest_author_date = DateTimeField(null=True)
+
+    class Meta:
+        primary_key = CompositeKey('project', 'branch', 'status')
+
+    @classmethod
+    def move(cls, commit, old_status, new_status):
+
+        """ Counts commit under new_status instead of old_status, either
+        of which may be None. Call inside a write transaction, after the
+        commit is saved. Dates are compared by SQLite, the same way the
+        commit listings order them. """
+
+        branch = ((cls.project == commit.project_id) 
+            & (cls.branch == commit.branch))
+        if old_status:
+            oldest = (Commit
+                .select(fn.MIN(Commit.author_date))
+                .where((Commit.project == commit.project_id)
+                    & (Commit.status == old_status)
+                    & (Commit.branch == commit.branch))
+                .scalar())
+            (cls.update(count=cls.count - 1, oldest_author_date=oldest)
+                .where(branch & (cls.status == old_status))
+                .execute())
+
+        if new_status:
+            date = commit.author_date
+            updated = (cls
+                .update(count=cls.count + 1, oldest_author_date=fn.MIN(
+                    fn.COALESCE(cls.oldest_author_date, date), date))
+                .where(branch & (cls.status == new_status))
+                .execute())
+            if not updated:
+                cls.insert(project=commit.project_id, branch=commit.branch,
+                    status=new_status, count=1, 
+                    oldest_author_date=date).execute()
+
+    @classmethod
+    def totals(cls, project=None):
+
+        """ Returns {project id: {status: (count, oldest author date)}},
+        summed over branches """
+
+        query = (cls
+            .select(cls.project, cls.status, fn.SUM(cls.count), 
+                fn.MIN(cls.oldest_author_date))
+            .where(cls.count > 0)
+            .group_by(cls.project, cls.status)
+            .tuples())
+        if project is not None:
+            query = query.where(cls.project == project)
+        totals = {}
+        for project_id, status, count, oldest in query:
+            totals.setdefault(project_id, {})[status] = (count, oldest)
+        return totals
+
+    @classmethod
+    def rebuild(cls):
+
+        """ Recounts everything from the commits table """
+
+        rows = (Commit
+            .select(Commit.project, Commit.branch, Commit.status,
+                fn.COUNT(Commit.id), fn.MIN(Commit.author_date))
+            .group_by(Commit.project, Commit.branch, Commit.status)
+            .tuples())
+        fields = ['project', 'branch', 'status', 'count', 
+            'oldest_author_date']
+        rows = [dict(zip(fields, row)) for row in rows]
+        with write_transaction():
+            cls.delete().execute()
+            for i in range(0, len(rows), 100):
+                cls.insert_many(rows[i:i + 100]).execute()
+
+class CommitSearch(object):
+
+    """ A SQLite FTS5 index of commit messages, authors and file paths,
+    one row per commit with the commit's id as rowid. The project and
+    status are indexed as columns too, so filters on them are resolved
+    by the index. Needs SQLite built with FTS5; everything here is a
+    no-op without it. """
+
+    TABLE = 'commitsearch'
+    _exists = False
+
+    @classmethod
+    def fts5_available(cls):
+        try:
+            database.execute_sql('CREATE VIRTUAL TABLE IF NOT EXISTS '
+                'temp.fts5_probe USING fts5(x)')
+            database.execute_sql('DROP TABLE temp.fts5_probe')
+        except OperationalError:
+            return False
+        return True
+
+    @classmethod
+    def exists(cls):
+
+        """ True once the table has been created, by create_tables or a
+        migration. Only a positive answer is remembered. """
+
+        if not cls._exists:
+            cls._exists = database.execute_sql('SELECT 1 FROM sqlite_master '
+                'WHERE name = ?', (cls.TABLE,)).fetchone() is not None
+        return cls._exists
+
+    @classmethod
+    def create_table(cls):
+
+        """ Creates the index if SQLite supports FTS5, returning whether
+        it exists. Prefixes of two and three characters are indexed for
+        quicker path and author lookups. """
+
+        if not cls.fts5_available():
+            return False
+        database.execute_sql('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING '
+            'fts5(message, author, paths, status, project, '
+            'prefix=\'2 3\')'%(cls.TABLE))
+        return True
+
+    @classmethod
+    def rebuild(cls):
+
+        """ Reindexes every commit """
+
+        if not cls.exists():
+            return
+        with write_transaction():
+            database.execute_sql('DELETE FROM %s'%(cls.TABLE))
+            database.execute_sql('INSERT INTO %s '
+                '(rowid, message, author, paths, status, project) '
+                'SELECT c.id, c.message, c.author_name || \' \' || '
+                'c.author_email, group_concat(f.file_path, char(10)), '
+                'c.status, CAST(c.project_id AS TEXT) FROM "commit" c LEFT JOIN '
+                'commitfile f ON f.commit_id = c.id GROUP BY c.id'
+                %(cls.TABLE))
+
+    @classmethod
+    def add(cls, commit, paths):
+
+        """ Indexes a newly recorded commit along with its file paths """
+
+        if not cls.exists():
+            return
+        database.execute_sql('INSERT OR REPLACE INTO %s '
+            '(rowid, message, author, paths, status, project) '
+            'VALUES (?, ?, ?, ?, ?, ?)'%(cls.TABLE), (commit.id, 
+            commit.message, '%s %s'%(commit.author_name, commit.author_email),
+            '\n'.join(paths), commit.status, str(commit.project_id)))
+
+    @classmethod
+    def set_status(cls, commit):
+        if not cls.exists():
+            return
+        database.execute_sql('UPDATE %s SET status = ? WHERE rowid = ?'%(
+            cls.TABLE), (commit.status, commit.id))
+
+    @staticmethod
+    def query(text, joiner):
+
+        """ Returns an FTS5 query of text's words joined by joiner, the 
+        last word matched as a prefix. None if it has no words. Only 
+        words are kept, so user input can't inject query syntax. """
+
+        words = re.findall(r'\w+', text, re.UNICODE)
+        if not words:
+            return None
+        return '(%s *)'%(joiner.join('"%s"'%(w) for w in words))
+
+    @classmethod
+    def search(cls, project, text=None, path=None, author=None, 
+            statuses=None, limit=50, offset=0):
+
+        """ Returns (commits, has_more) for a project's commits whose 
+        message, author or paths have all of text's words, with a file
+        path starting with path and an author name or email starting 
+        with author. Best matches come first, or newest first when 
+        there's nothing to rank by.
+
+        The index only narrows path down to commits with its words in
+        order somewhere in their paths; each of those is then checked 
+        for a file path that really starts with path. """
+
+        path = (path or '').lstrip('/')
+        terms = ['project : "%d"'%(getattr(project, 'id', project))]
+        if statuses:
+            terms.append('status : (%s)'%(' OR '.join('"%s"'%(s) 
+                for s in statuses if re.match(r'^\w+$', s)) or '""'))
+        ranked = False
+        # Words of text in any order, path and author as phrases
+        for column, value, joiner in [('', text, ' '), 
+                ('paths : ', path, ' + '), ('author : ', author, ' + ')]:
+            query = cls.query(value or '', joiner)
+            if query:
+                terms.append(column + query)
+                ranked = True
+
+        where, params = '%s MATCH ?'%(cls.TABLE), [' AND '.join(terms)]
+        if path:
+            where += (' AND EXISTS (SELECT 1 FROM commitfile f WHERE '
+                'f.commit_id = %s.rowid AND f.file_path >= ? AND '
+                'f.file_path < ?)'%(cls.TABLE))
+            params.extend(CommitFile.prefix_bounds(path))
+
+        order = 'rank' if ranked else 'rowid DESC'
+        rows = database.execute_sql('SELECT rowid FROM %s WHERE %s '
+            'ORDER BY %s LIMIT ? OFFSET ?'%(cls.TABLE, where, order), 
+            params + [limit + 1, offset]).fetchall()
+        ids = [row[0] for row in rows[:limit]]
+        commits = dict((c.id, c) for c in Commit.select()
+            .where(Commit.id << ids)) if ids else {}
+        return [commits[cid] for cid in ids if cid in commits], len(rows) > limit
+
+class FileConflictIndex(object):
+
+    """ Maps each file path touched by a project's pending commits to
+    those commits, oldest first, so the approved commits that can merge
+    are found with two queries rather than one per pair of commits. """
+
+    def __init__(self, project):
+        self.project = project
+        self.paths = {}
+        self.files = {}
+        self.dates = {}
+        self.closed = set()
+        rows = (CommitFile
+            .select(CommitFile.file_path, Commit.id, Commit.author_date)
+            .join(Commit)
+            .where((Commit.project == project)
+                & (Commit.status != 'merged') 
+                & (Commit.status != 'rejected')
+                & (Commit.status != 'outdated'))
+            .order_by(Commit.author_date.asc())
+            .tuples())
+        for fpath, cid, author_date in rows:
+            self.paths.setdefault(fpath, collections.deque()).append(cid)
+            self.files.setdefault(cid, []).append(fpath)
+            self.dates[cid] = author_date
+
+    def oldest(self, fpath):
+
+        """ Returns the author date of the oldest pending commit 
+        touching fpath """
+
+        pending = self.paths.get(fpath)
+        while pending and pending[0] in self.closed:
+            pending.popleft()
+        if not pending:
+            return None
+        return self.dates[pending[0]]
+
+    def can_merge(self, commit):
+        author_date = self.dates.get(commit.id, commit.author_date)
+        for fpath in self.files.get(commit.id, []):
+            oldest = self.oldest(fpath)
+            if oldest is not None and oldest < author_date:
+                return False
+        return True
+
+    def close(self, commit):
+
+        """ Marks a commit as no longer pending, unblocking newer 
+        commits that touch the same files """
+
+        self.closed.add(commit.id)
+
+    def mergeable(self):
+
+        """ Yields the approved commits that can merge, oldest first.
+        Each is closed as it is yielded, since it will either merge
+        or be marked outdated. """
+
+        approved = (Commit
+            .select()
+            .where((Commit.status == 'approved') 
+                & (Commit.project == self.project))
+            .order_by(Commit.author_date.asc()))
+        for commit in approved:
+            if self.can_merge(commit):
+                self.close(commit)
+                yield commit
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Opt-in profiling of web requests, turned on with PROFILE_REQUESTS.
+
+A sample of requests, PROFILE_SAMPLE_RATE of them, plus those an admin
+makes with ?profile=1, run under cProfile. Their time is also split
+into SQL, git, diffing and template rendering as it's spent, each
+section counting only its own time, not that of sections inside it:
+a template's time excludes the queries it runs. The PROFILE_KEEP
+slowest profiles are kept in PROFILE_DIR, as a JSON summary and a
+pstats dump each.
+"""
+import cProfile
+import cStringIO
+import json
+import os
+import pstats
+import threading
+import time
+import uuid
+import ggconf
+
+PROFILE_REQUESTS = getattr(ggconf, 'PROFILE_REQUESTS', False)
+PROFILE_SAMPLE_RATE = getattr(ggconf, 'PROFILE_SAMPLE_RATE', 0.01)
+PROFILE_DIR = getattr(ggconf, 'PROFILE_DIR', os.path.join(
+    os.path.dirname(os.path.abspath(ggconf.DATABASE)), 'profiles'))
+PROFILE_KEEP = getattr(ggconf, 'PROFILE_KEEP', 20)
+
+SECTIONS = ['sql', 'git', 'diff', 'template']
+
+_local = threading.local()
+_store_lock = threading.Lock()
+
+class Profile(object):
+
+    """ A request being profiled on the current thread """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.seconds = dict((name, 0.0) for name in SECTIONS)
+        self.counts = dict((name, 0) for name in SECTIONS)
+        self.stack = []
+        self.started = None
+        self.total = None
+
+    def start(self):
+        self.started = time.time()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.total = time.time() - self.started
+
+    def summary(self, **details):
+        summary = dict(details, started=self.started,
+            seconds=round(self.total, 4), counts=self.counts,
+            sections=dict((name, round(seconds, 4))
+                for name, seconds in self.seconds.items()))
+        summary['sections']['other'] = round(
+            self.total - sum(self.seconds.values()), 4)
+        return summary
+
+def current():
+    return getattr(_local, 'profile', None)
+
+def start():
+
+    """ Starts profiling the current thread, returning the Profile """
+
+    profile = _local.profile = Profile()
+    profile.start()
+    return profile
+
+def stop():
+
+    """ Stops profiling the current thread, returning the Profile or
+    None if it wasn't being profiled """
+
+    profile = current()
+    _local.profile = None
+    if profile is not None:
+        profile.stop()
+    return profile
+
+def add(name, seconds, calls=1):
+
+    """ Counts seconds spent in a section, taking them out of the
+    section it ran inside of """
+
+    profile = current()
+    if profile is None:
+        return
+    profile.seconds[name] += seconds
+    profile.counts[name] += calls
+    if profile.stack:
+        profile.seconds[profile.stack[-1]] -= seconds
+
+class section(object):
+
+    """ Counts the time spent in a with block towards a section """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.profile = current()
+        if self.profile is not None:
+            self.start = time.time()
+            self.profile.stack.append(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profile is not None and self.profile is current():
+            self.profile.stack.pop()
+            add(self.name, time.time() - self.start)
+
+def timed(name, iterable):
+
+    """ Yields from iterable, counting the time taken producing each
+    item towards a section, and not the time spent consuming it """
+
+    iterator = iter(iterable)
+    while True:
+        with section(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+### ----------------------------------------------------------------------------
+### Storage
+### ----------------------------------------------------------------------------
+
+def stored(path=PROFILE_DIR):
+
+    """ Returns the kept profiles' summaries, slowest first """
+
+    summaries = []
+    if not os.path.isdir(path):
+        return summaries
+    for name in os.listdir(path):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(path, name)) as fh:
+                summary = json.load(fh)
+        except (IOError, ValueError):
+            continue
+        summary['id'] = name[:-len('.json')]
+        summaries.append(summary)
+    return sorted(summaries, key=lambda s: s['seconds'], reverse=True)
+
+def store(profile, path=PROFILE_DIR, keep=PROFILE_KEEP, **details):
+
+    """ Keeps profile if it's among the keep slowest, returning its id,
+    or None if it was faster than all of them """
+
+    with _store_lock:
+        kept = stored(path)
+        if len(kept) >= keep and profile.total <= kept[keep - 1]['seconds']:
+            return None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        profile_id = '%d-%s'%(profile.started, uuid.uuid4().hex[:8])
+        base = os.path.join(path, profile_id)
+        profile.profile.dump_stats(base + '.prof')
+        with open(base + '.json', 'w') as fh:
+            json.dump(profile.summary(**details), fh)
+        for old in kept[keep - 1:]:
+            for ext in ['.json', '.prof']:
+                try:
+                    os.remove(os.path.join(path, old['id'] + ext))
+                except OSError:
+                    pass
+    return profile_id
+
+def load(profile_id, path=PROFILE_DIR, sort='cumulative', limit=60):
+
+    """ Returns (summary, pstats text) for a kept profile, or None """
+
+    if os.path.basename(profile_id) != profile_id:
+        return None
+    base = os.path.join(path, profile_id)
+    try:
+        with open(base + '.json') as fh:
+            summary = json.load(fh)
+        out = cStringIO.StringIO()
+        stats = pstats.Stats(base + '.prof', stream=out)
+    except (IOError, ValueError):
+        return None
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return summary, out.getvalue()
@@ -3,38 +3,91 @@ import subprocess
 import os
 import json
 import shutil 
+import tempfile
+import threading
+import Queue
+import binascii
 import dateutil.parser
 import re
-import difflib
+import time
+import diff
+import gittrace
+import metrics
 
-def command(cmds, cwd=None, minstatus=0):
+def command(cmds, cwd=None, minstatus=0, env=None, input=None):
     if not cwd:
         cwd = os.getcwd()
+    stdin = None
+    if input is not None:
+        stdin = subprocess.PIPE
+    start = time.time()
     p = subprocess.Popen(cmds,
+        stdin=stdin,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        cwd=cwd)
-    stdout, stderr = p.communicate()
+        cwd=cwd,
+        env=env)
+    stdout, stderr = p.communicate(input)
     status = p.returncode
+    seconds = time.time() - start
+    metrics.observe_git(cmds, seconds)
+    gittrace.record(cmds, cwd, seconds, status, len(stdout))
     if status > minstatus:
         raise Exception('Error executing %s, error: %s'%(' '.join(cmds), stderr))
     return stdout
 
-def git_command(cmd, cwd=None, args=[]):
+def stream_command(cmds, cwd=None):
+
+    """ Runs a command, yielding its output line by line as it
+    is produced rather than buffering all of it """
+
+    if not cwd:
+        cwd = os.getcwd()
+    errors = tempfile.TemporaryFile()
+    start = time.time()
+    p = subprocess.Popen(cmds,
+        stdout=subprocess.PIPE,
+        stderr=errors,
+        cwd=cwd)
+    output_bytes = 0
+    for line in iter(p.stdout.readline, ''):
+        output_bytes += len(line)
+        yield line
+    p.stdout.close()
+    status = p.wait()
+    seconds = time.time() - start
+    metrics.observe_git(cmds, seconds)
+    gittrace.record(cmds, cwd, seconds, status, output_bytes)
+    if status > 0:
+        errors.seek(0)
+        raise Exception('Error executing %s, error: %s'%(' '.join(cmds), 
+            errors.read()))
+
+def git_command(cmd, cwd=None, args=[], env=None, input=None):
+
+    """ Runs a git subcommand. env holds variables to set on top 
+    of the current environment, input is written to stdin. """
 
     if not cwd:
         cwd = os.getcwd()
+    if env:
+        env = dict(os.environ, **env)
     cmds = ['/usr/bin/git',cmd] + args
-    stdout = command(cmds, cwd=cwd)
+    stdout = command(cmds, cwd=cwd, env=env, input=input)
     return stdout
 
+def git_stream(cmd, cwd=None, args=[]):
+
+    if not cwd:
+        cwd = os.getcwd()
+    cmds = ['/usr/bin/git',cmd] + args
+    return stream_command(cmds, cwd=cwd)
+
 def unified_diff(to_file_path, from_file_path, context=1):
 
     """ Returns a list of differences between two files based
     on some context. This is probably over-complicated. """
 
-    pat_diff = re.compile(r'@@ (.[0-9]+\,[0-9]+) (.[0-9]+,[0-9]+) @@')
-
     from_lines = []
     if os.path.exists(from_file_path):
         from_fh = open(from_file_path,'r')
@@ -47,41 +100,203 @@ def unified_diff(to_file_path, from_file_path, context=1):
         to_lines = to_fh.readlines()
         to_fh.close()
 
-    diff_lines = [] 
+    return unified_diff_lines(to_lines, from_lines, context)
 
-    lines = difflib.unified_diff(to_lines, from_lines, n=context)
-    for line in lines:
-        if line.startswith('--') or line.startswith('++'):
-            continue
+def unified_diff_lines(to_lines, from_lines, context=1,
+        timeout=diff.DEFAULT_TIMEOUT):
 
-        m = pat_diff.match(line)
-        if m:
-            left = m.group(1)
-            right = m.group(2)
-            lstart = left.split(',')[0][1:]
-            rstart = right.split(',')[0][1:]
-            diff_lines.append("@@ %s %s @@\n"%(left, right))
-            to_lnum = int(lstart)
-            from_lnum = int(rstart)
-            continue
+    """ Same as unified_diff, for lists of lines. See diff.py for the 
+    algorithm and what happens when it runs out of time. """
 
-        code = line[0]
+    return list(diff.unified_diff(to_lines, from_lines, context, 
+        timeout=timeout))
 
-        lnum = from_lnum
-        if code == '-':
-            lnum = to_lnum
-        diff_lines.append("%s%.4d: %s"%(code, lnum, line[1:]))
+class CatFile(object):
 
-        if code == '-':
-            to_lnum += 1
-        elif code == '+':
-            from_lnum += 1
-        else:
-            to_lnum += 1
-            from_lnum += 1
+    """ A single long-lived git cat-file --batch or --batch-check 
+    process. Not thread safe, see GitObjectReader. """
 
-    return diff_lines
+    def __init__(self, cwd, mode='--batch'):
+        self.cwd = cwd
+        self.mode = mode
+        self.process = None
 
+    def start(self):
+        # The child keeps its own copy of devnull, ours can go
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen(
+                ['/usr/bin/git', 'cat-file', self.mode],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=devnull,
+                cwd=self.cwd)
+
+    def close(self):
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def query(self, rev):
+
+        """ Returns (sha1, type, size, data) for rev, or None if the
+        object doesn't exist. data is None in --batch-check mode. """
+
+        if '\n' in rev:
+            raise ValueError('Invalid object name: %r'%(rev))
+        if not self.process or self.process.poll() is not None:
+            self.start()
+        try:
+            self.process.stdin.write(rev + '\n')
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+            if not header:
+                raise IOError('git cat-file exited in %s'%(self.cwd))
+            parts = header.rstrip('\n').rsplit(' ', 2)
+            if parts[-1] in ['missing', 'ambiguous']:
+                return None
+            sha1, otype, size = parts[0], parts[1], int(parts[2])
+            data = None
+            if self.mode == '--batch':
+                data = self.process.stdout.read(size)
+                self.process.stdout.read(1)
+            return sha1, otype, size, data
+        except:
+            # The stream can't be trusted after a partial read
+            self.close()
+            raise
+
+class GitObjectReader(object):
+
+    """ A small pool of long-lived git cat-file processes reading 
+    objects from one repository, so lookups don't fork a new git. 
+    Thread safe. A process that dies is restarted on the next lookup. """
+
+    def __init__(self, cwd, size=2):
+        self.cwd = cwd
+        self.size = size
+        self.idle = Queue.Queue()
+        for i in range(size):
+            self.idle.put({})
+
+    def query(self, rev, mode='--batch'):
+        processes = self.idle.get()
+        # Timed once a process is free, so waits for one aren't counted
+        start = time.time()
+        # Traced as exiting 1 when the object is missing, like 
+        # cat-file -e, and -1 on errors
+        result, status = None, -1
+        try:
+            if mode not in processes:
+                processes[mode] = CatFile(self.cwd, mode)
+            try:
+                result = processes[mode].query(rev)
+            except (IOError, OSError):
+                # Retry once on a fresh process
+                result = processes[mode].query(rev)
+            status = 0 if result else 1
+            return result
+        finally:
+            self.idle.put(processes)
+            seconds = time.time() - start
+            cmds = ['/usr/bin/git', 'cat-file', mode, rev]
+            metrics.observe_git(cmds, seconds)
+            gittrace.record(cmds, self.cwd, seconds, status, 
+                len(result[3] or '') if result else 0)
+
+    def close(self):
+
+        """ Stops the processes of every slot, waiting for those in use
+        to be handed back """
+
+        slots = [self.idle.get() for i in range(self.size)]
+        try:
+            for processes in slots:
+                for cat_file in processes.values():
+                    cat_file.close()
+        finally:
+            for processes in slots:
+                self.idle.put(processes)
+
+    def info(self, rev):
+
+        """ Returns (sha1, type, size) for rev or None if missing """
+
+        found = self.query(rev, mode='--batch-check')
+        if not found:
+            return None
+        return found[:3]
+
+    def read(self, rev, otype=None):
+
+        """ Returns the contents of rev, or None if it's missing or
+        isn't an object of type otype """
+
+        found = self.query(rev)
+        if not found or (otype and found[1] != otype):
+            return None
+        return found[3]
+
+    def read_commit(self, rev):
+
+        """ Returns a commit's tree, parents, author details and message """
+
+        data = self.read(rev, otype='commit')
+        if data is None:
+            return None
+        headers, message = data.split('\n\n', 1)
+        commit = {'parents':[], 'message':message}
+        for line in headers.split('\n'):
+            key, value = line.split(' ', 1)
+            if key == 'tree':
+                commit['tree'] = value
+            elif key == 'parent':
+                commit['parents'].append(value)
+            elif key == 'author':
+                m = re.match(r'^(.*) <(.*)> (.*)$', value)
+                commit['author_name'] = m.group(1)
+                commit['author_email'] = m.group(2)
+                commit['author_date_raw'] = m.group(3)
+        return commit
+
+    def read_tree(self, rev):
+
+        """ Returns a tree's entries as (mode, name, sha1) tuples """
+
+        data = self.read(rev, otype='tree')
+        if data is None:
+            return None
+        entries = []
+        pos = 0
+        while pos < len(data):
+            space = data.index(' ', pos)
+            nul = data.index('\0', space)
+            entries.append((data[pos:space], data[space + 1:nul],
+                binascii.hexlify(data[nul + 1:nul + 21])))
+            pos = nul + 21
+        return entries
+
+_readers = {}
+_readers_lock = threading.Lock()
+
+def object_reader(path):
+
+    """ Returns the shared GitObjectReader for the repository at path """
+
+    with _readers_lock:
+        reader = _readers.get(path)
+        if reader is None:
+            reader = _readers[path] = GitObjectReader(path)
+    return reader
+
+class MergeError(Exception):
+
+    """ A batch of merges failed. sha1 is the commit that could not
+    be applied, or None when the push itself failed. """
+
+    def __init__(self, message, sha1=None):
+        Exception.__init__(self, message)
+        self.sha1 = sha1
 
 class GitProject(object):   
 
@@ -98,6 +313,18 @@ class GitProject(object):
     def stable_path(self):
         return os.path.join(self.config.path, 'stable')
 
+    @property
+    def devel_objects(self):
+        return object_reader(self.devel_path)
+
+    @property
+    def stable_objects(self):
+
+        """ Reads objects from stable, which also holds the devel 
+        objects fetched through its devel remote """
+
+        return object_reader(self.stable_path)
+
     def clone_branch_to_stable(self, branch):
         try:
             git_command('fetch', cwd=self.stable_path, args=['--all'])
@@ -119,6 +346,21 @@ class GitProject(object):
             self.clone_branch_to_stable(branch)
         git_command('pull', cwd=self.stable_path, args=['origin',branch])
 
+    def get_remote_tips(self, branches):
+
+        """ Returns the devel and stable tips of the given branches
+        as a string, without fetching anything """
+
+        refs = ['refs/heads/%s'%(b) for b in branches]
+        tips = []
+        for remote in ['origin', 'devel']:
+            output = git_command('ls-remote', cwd=self.stable_path,
+                args=['--heads', remote] + refs)
+            for line in output.split('\n'):
+                if line.strip():
+                    tips.append('%s %s'%(remote, line.strip()))
+        return '\n'.join(sorted(tips))
+
     def create_devel_checkout(self):
         if os.path.exists(self.devel_path):
             # Remove dpath
@@ -137,49 +379,142 @@ class GitProject(object):
         return True
 
 
-    def merge_commit(self, sha1, branch='master'):
+    def diff_trees(self, old_tree, new_tree, prefix=''):
 
-        """ Merges commits via manual copying """
+        """ Yields (STATUS, mode, sha1, path) for every blob that 
+        differs between two trees, skipping subtrees that match """
 
-        git_command('checkout', cwd=self.devel_path, args=[sha1])
-        git_command('checkout', cwd=self.stable_path, args=[branch])
-        flist = self.get_commit_file_changes(sha1, branch=branch)
-        for fc in flist:
-            t, fname = fc
-            devel_path = os.path.join(self.devel_path, fname)
-            stable_path = os.path.join(self.stable_path, fname)
+        old_entries, new_entries = {}, {}
+        if old_tree:
+            old_entries = dict((name, (mode, sha1)) for mode, name, sha1
+                in self.stable_objects.read_tree(old_tree))
+        if new_tree:
+            new_entries = dict((name, (mode, sha1)) for mode, name, sha1
+                in self.stable_objects.read_tree(new_tree))
 
+        for name in sorted(set(old_entries) | set(new_entries)):
+            old = old_entries.get(name)
+            new = new_entries.get(name)
+            if old == new:
+                continue
+            path = prefix + name
+            old_subtree = old and old[0] == '40000' and old[1]
+            new_subtree = new and new[0] == '40000' and new[1]
+            if old and not old_subtree and not new:
+                yield 'D', old[0], old[1], path
+            elif new and not new_subtree and not old:
+                yield 'A', new[0], new[1], path
+            elif not old_subtree and not new_subtree:
+                yield 'M', new[0], new[1], path
+            else:
+                if old and not old_subtree:
+                    yield 'D', old[0], old[1], path
+                for change in self.diff_trees(old_subtree, new_subtree,
+                        path + '/'):
+                    yield change
+                if new and not new_subtree:
+                    yield 'A', new[0], new[1], path
+
+    def apply_commit(self, sha1, parent, env):
+
+        """ Builds the stable commit for a devel commit straight from
+        git objects: its changed entries are written over parent's tree 
+        in the temporary index named by env, and committed with the 
+        original author details. Returns the new commit's sha1. """
+
+        details = self.stable_objects.read_commit(sha1)
+        if not details:
+            raise Exception('Commit %s not found in stable'%(sha1))
+        parent_tree = None
+        if details['parents']:
+            parent_tree = self.stable_objects.read_commit(
+                details['parents'][0])['tree']
+
+        entries = []
+        for t, mode, blob_sha1, fname in self.diff_trees(parent_tree, 
+                details['tree']):
             if t == 'D':
-                git_command('rm', cwd=self.stable_path, 
-                    args=[fname])
-            elif t in ['A', 'M']:
-                shutil.copy2(devel_path, stable_path)
-                git_command('add', cwd=self.stable_path,
-                    args=[fname])                
+                entries.append('0 %s\t%s'%('0' * len(blob_sha1), fname))
             else:
-                raise Exception('Unknown merge type: %s'%(t))
-        
-        git_command('commit', cwd=self.stable_path,
-            args=['-C',sha1])
-        git_command('push', cwd=self.stable_path,
-            args=['origin', branch])
-        git_command('checkout', cwd=self.devel_path, args=['master'])
-        self.config.last_merge_sha1 = sha1
+                entries.append('%s %s\t%s'%(mode, blob_sha1, fname))
+        if entries:
+            git_command('update-index', cwd=self.stable_path, 
+                args=['-z', '--index-info'], env=env,
+                input='\0'.join(entries) + '\0')
+        tree = git_command('write-tree', cwd=self.stable_path, 
+            env=env).strip()
+
+        author_env = {
+            'GIT_AUTHOR_NAME':details['author_name'],
+            'GIT_AUTHOR_EMAIL':details['author_email'],
+            'GIT_AUTHOR_DATE':details['author_date_raw'],
+        }
+        return git_command('commit-tree', cwd=self.stable_path,
+            args=[tree, '-p', parent], env=author_env, 
+            input=details['message']).strip()
+
+    def merge_commits(self, sha1s, branch='master'):
+
+        """ Merges commits without touching either checkout, one stable
+        commit per devel commit, then pushes them all at once. If any 
+        step fails nothing is pushed, so stable stays at its tip from 
+        before the batch, and MergeError is raised. """
+
+        tip = git_command('rev-parse', cwd=self.stable_path, 
+            args=['--verify', 'refs/remotes/origin/%s'%(branch)]).strip()
+        index_dir = tempfile.mkdtemp(prefix='gitgate-')
+        env = {'GIT_INDEX_FILE':os.path.join(index_dir, 'index')}
+        try:
+            git_command('read-tree', cwd=self.stable_path, args=[tip],
+                env=env)
+            for sha1 in sha1s:
+                try:
+                    tip = self.apply_commit(sha1, tip, env)
+                except Exception as err:
+                    raise MergeError(str(err), sha1=sha1)
+            try:
+                git_command('push', cwd=self.stable_path,
+                    args=['origin', '%s:refs/heads/%s'%(tip, branch)])
+            except Exception as err:
+                raise MergeError(str(err))
+        finally:
+            shutil.rmtree(index_dir, ignore_errors=True)
+        self.config.last_merge_sha1 = sha1s[-1]
         self.config.save()
         return True
 
-    def get_commit_details(self, sha1):
-        output = git_command('show', cwd=self.devel_path,
-            args=['--format=%H|xsplit|%an|xsplit|%ae|xsplit|%ai|xsplit|%s|xsplit|', 
-            sha1])
-        parts = output.split('|xsplit|')
-        data = { 
-            'author_name':parts[1],
-            'author_email':parts[2],
-            'author_date':dateutil.parser.parse(parts[3]),
-            'message':parts[4]
-        }
-        return data
+    def merge_commit(self, sha1, branch='master'):
+        return self.merge_commits([sha1], branch=branch)
+
+    def get_commits(self, sha1s, chunk_size=500):
+
+        """ Returns the details and file changes of many commits,
+        in the order given, reading a single git log per chunk """
+
+        fmt = '%x00%H%x00%an%x00%ae%x00%ai%x00%s'
+        found = {}
+        for i in range(0, len(sha1s), chunk_size):
+            lines = git_stream('log', cwd=self.stable_path,
+                args=['--no-walk=unsorted', '--no-renames', '--name-status',
+                    '--format=%s'%(fmt)] + sha1s[i:i + chunk_size])
+            current = None
+            for line in lines:
+                line = line.rstrip('\n')
+                if line.startswith('\x00'):
+                    sha1, name, email, date, subject = line[1:].split('\x00')
+                    current = {
+                        'sha1':sha1,
+                        'author_name':name,
+                        'author_email':email,
+                        'author_date':dateutil.parser.parse(date),
+                        'message':subject,
+                        'file_changes':[]
+                    }
+                    found[sha1] = current
+                elif current is not None and line.strip():
+                    status, name = line.split('\t', 1)
+                    current['file_changes'].append([status, name])
+        return [found[sha1] for sha1 in sha1s if sha1 in found]
 
     def get_sha1_diffs(self, branch='master'):
 
@@ -198,16 +533,33 @@ class GitProject(object):
         diffs = [sha.split(' ')[-1] for sha in shas if '+' in sha]
         return diffs
 
-    def get_unified_diff(self, sha1, fpath, branch='master', context=5):
-    
-        git_command('checkout', cwd=self.devel_path, args=[sha1])
-        git_command('checkout', cwd=self.stable_path, args=[branch])
-        git_command('pull', cwd=self.stable_path, args=['origin',branch])
+    def file_diff(self, sha1, fpath, branch='master', context=5,
+            timeout=diff.DEFAULT_TIMEOUT):
+
+        """ Returns a diff.UnifiedDiff of fpath between a devel commit 
+        and the tip of the stable branch, reading both sides from git 
+        objects. Nothing is checked out or pulled, so this is safe to 
+        run alongside the daemon. Lines are produced as they're 
+        iterated. """
 
-        to_fpath = os.path.join(self.stable_path, fpath)
-        from_fpath = os.path.join(self.devel_path, fpath)
-        return ''.join(unified_diff(to_fpath, from_fpath, context))
+        to_data = self.stable_objects.read('refs/remotes/origin/%s:%s'%(
+            branch, fpath), otype='blob') or ''
+        from_data = self.devel_objects.read('%s:%s'%(sha1, fpath), 
+            otype='blob') or ''
+        return diff.unified_diff(to_data.splitlines(True), 
+            from_data.splitlines(True), context, timeout=timeout)
 
+    def get_diff_key(self, sha1, fpath, branch='master', context=5):
+
+        """ Returns a cache key for file_diff naming the blobs on 
+        either side, so it changes whenever either side does. Diffs 
+        that come out degraded mustn't be cached under it. """
+
+        to_blob = self.stable_objects.info('refs/remotes/origin/%s:%s'%(
+            branch, fpath))
+        from_blob = self.devel_objects.info('%s:%s'%(sha1, fpath))
+        return 'diff3:%s:%s:%d'%(to_blob and to_blob[0], 
+            from_blob and from_blob[0], context)
 
     def get_stable_diff(self, sha1, fpath, branch='master', full_diff=True):
 
@@ -234,22 +586,3 @@ class GitProject(object):
             args=['--no-prefix', '-U10000', sha1+'^', sha1, fpath])
         output = re.split(r'@@.*?@@', output, 1)[-1]
         return output
-
-    def get_commit_file_changes(self, sha1, branch="master"):
-
-        """ Returns a list of STATUS, FILENAME changes """
-    
-        output = git_command('show', cwd=self.stable_path,
-            args=['--name-status', '--format=%mSTART>>>', sha1])
-        #print "OUTPUT: ===\n%s\n==="%(output)
-        status_names = output.split('START>>>')[-1].split('\n')
-        #print "STATUS NAMES = '''\n%s\n'''"%(status_names)
-        stat_list = []
-        for sname in status_names:
-            #print "SNAME: ", sname
-            if len(sname.strip()) < 1:
-                continue
-            status, name = sname.split('\t', 1)
-            stat_list.append([status, name])
-        return stat_list
-
@@ -1,12 +1,86 @@
 import flask as f
 import peewee
 import models as md
-import re
+import migrations
+import cache
+import assets
+import gittrace
+import metrics
+import profiler
+from diff import render_html
+import ggconf
 from functools import wraps
+from flask.templating import Environment
+import jinja2
+from werkzeug.security import safe_join
+import datetime
 import hashlib
+import mimetypes
+import os
+import random
+import time
 from gitgate import __version__
 
-app = f.Flask(__name__)
+DIFF_TIMEOUT = getattr(ggconf, 'DIFF_TIMEOUT', 2.0)
+METRICS_ENABLED = getattr(ggconf, 'METRICS_ENABLED', True)
+# How long browsers keep static files requested by fingerprinted URL
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+class ProfiledTemplate(jinja2.Template):
+
+    """ Counts rendering towards the template section of profiles """
+
+    def render(self, *args, **kwargs):
+        with profiler.section('template'):
+            return super(ProfiledTemplate, self).render(*args, **kwargs)
+
+    def generate(self, *args, **kwargs):
+        return profiler.timed('template', 
+            super(ProfiledTemplate, self).generate(*args, **kwargs))
+
+class GitGateEnvironment(Environment):
+    template_class = ProfiledTemplate
+
+class GitGate(f.Flask):
+
+    """ Serves static files gzipped to clients that accept it, and 
+    lets browsers keep them for good when requested by a URL carrying
+    their fingerprint, see url_for """
+
+    def send_static_file(self, filename):
+        path = safe_join(self.static_folder, filename)
+        data = None
+        if path and 'gzip' in f.request.headers.get('Accept-Encoding', ''):
+            data = assets.gzipped(path)
+        if data is None:
+            response = super(GitGate, self).send_static_file(filename)
+        else:
+            response = self.response_class(data, 
+                mimetype=mimetypes.guess_type(filename)[0])
+            response.headers['Content-Encoding'] = 'gzip'
+            response.set_etag(assets.fingerprint(path) + '-gzip')
+            response.make_conditional(f.request)
+        response.vary.add('Accept-Encoding')
+
+        version = f.request.args.get('v')
+        if path and version and version == assets.fingerprint(path):
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+        return response
+
+    jinja_environment = GitGateEnvironment
+
+app = GitGate(__name__)
+
+# Refuse to start on an older schema rather than failing on missing
+# columns request by request
+migrations.check_current()
+md.database.close()
+
+diff_cache = cache.DiffCache(
+    memory_bytes=getattr(ggconf, 'DIFF_CACHE_BYTES', 32 * 1024 * 1024),
+    disk_path=getattr(ggconf, 'DIFF_CACHE_DIR', None),
+    disk_bytes=getattr(ggconf, 'DIFF_CACHE_DISK_BYTES', 0))
 
 ### ----------------------------------------------------------------------------
 ### Helper functions
@@ -17,7 +91,7 @@ def requires_admin():
         @wraps(fn)
         def wrapped(*args, **kwargs):
             user = get_user()
-            if not user.is_admin:
+            if not user or not user.is_admin:
                 add_error("You're not authorized to do that")
                 f.abort(403)
             return fn(*args, **kwargs)
@@ -36,9 +110,14 @@ def requires_user(role=None):
             if user.is_admin:
                 return fn(*args, **kwargs)
 
-            if role and not user.has_project_role(get_project(), role):
-                add_error('You need the project role %s to do that'%(role))
-                f.abort(403)
+            if role:
+                try:
+                    project = get_project()
+                except md.Project.DoesNotExist:
+                    f.abort(404)
+                if not user.has_project_role(project, role):
+                    add_error('You need the project role %s to do that'%(role))
+                    f.abort(403)
 
             return fn(*args, **kwargs)
         return wrapped
@@ -51,22 +130,85 @@ def add_error(msg):
     f.flash(msg, category='error')
 
 def get_user():
-    if not f.session.get('user_id'):
-        return None
-    try:
-        user = md.User.get(id=f.session.get('user_id'))
-        f.g.user = user
-    except:
-        return None
+
+    """ Returns the signed in user, or None, looked up once per 
+    request along with their project roles """
+
+    if hasattr(f.g, 'user'):
+        return f.g.user
+    f.g.user = None
+    if f.session.get('user_id'):
+        try:
+            f.g.user = md.User.get(id=f.session.get('user_id'))
+        except md.User.DoesNotExist:
+            pass
     return f.g.user
 
 def get_project():
-    m = re.search(r'.*?/project/([0-9]+)/.*?', f.request.path)
-    if m:
-        return md.Project.get(id=m.groups(0))
-    return None
+
+    """ Returns the project named by the route's pid, looked up once
+    per request. Raises Project.DoesNotExist for unknown projects. """
+
+    if not hasattr(f.g, 'project'):
+        pid = (f.request.view_args or {}).get('pid')
+        f.g.project = md.Project.get(id=pid) if pid is not None else None
+    return f.g.project
+
+def roles_changed():
+
+    """ Drops cached roles after project roles are added or removed """
+
+    md.Role.clear_cache()
+    user = getattr(f.g, 'user', None)
+    if user:
+        user.clear_project_roles()
+
+def stream_template(template_name, **context):
+
+    """ Like render_template, but yields the page in pieces """
+
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(20)
+    return stream
+
+def page_etag(*parts):
+
+    """ Returns an ETag for a page built from parts, which should name
+    everything the page shows. The viewer and their roles are added,
+    since they decide which actions are shown. """
+
+    user = get_user()
+    viewer = None
+    if user:
+        viewer = (user.id, user.name, user.is_admin, 
+            sorted(user.project_roles.items()))
+    return hashlib.sha1(repr((__version__, viewer, parts))).hexdigest()
+
+def conditional(etag, render):
+
+    """ Answers 304 Not Modified if the client already has the page
+    tagged etag, otherwise returns render() with the tag. Pages with
+    flashed messages waiting are always rendered, as those show once. """
+
+    if f.session.get('_flashes'):
+        return render()
+    if f.request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = f.make_response(render())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 def url_for(fn, **kwargs):
+    if fn == 'static' and 'filename' in kwargs:
+        # A fingerprinted URL changes with the file, so it can be cached
+        version = assets.fingerprint(os.path.join(app.static_folder, 
+            kwargs['filename']))
+        if version:
+            kwargs['v'] = version
     path = app.config.get('URL_PREFIX','') + f.url_for(fn, **kwargs)
     return path
 
@@ -87,14 +229,48 @@ def injext_url_for():
 
 @app.before_request
 def before_request():
+    f.g.started = time.time()
+    metrics.reset_queries()
     f.g.db = md.database
     f.g.db.connect()
 
+    if not profiler.PROFILE_REQUESTS:
+        return
+    if random.random() < profiler.PROFILE_SAMPLE_RATE or (
+            f.request.args.get('profile') and get_user() 
+            and get_user().is_admin):
+        profiler.start()
+
 @app.after_request
 def after_request(response):
-    f.g.db.close()
+    f.g.status = response.status_code
     return response
 
+@app.teardown_request
+def teardown_request(exc):
+
+    """ Hands the connection back, or to the pool, once the request is
+    done. Unlike after_request this also runs after errors, and after a
+    streamed response has finished. """
+
+    profile = profiler.stop()
+    if profile is not None:
+        profiler.store(profile, url=f.request.full_path, 
+            endpoint=f.request.endpoint, method=f.request.method,
+            status=getattr(f.g, 'status', 500))
+
+    db = getattr(f.g, 'db', None)
+    if db is not None and not db.is_closed():
+        db.close()
+
+    started = getattr(f.g, 'started', None)
+    if started is not None:
+        endpoint = f.request.endpoint or 'none'
+        metrics.request_seconds.observe(time.time() - started, 
+            endpoint=endpoint, method=f.request.method)
+        metrics.request_queries.observe(metrics.reset_queries(),
+            endpoint=endpoint)
+
 @app.route('/')
 def index():
     return f.redirect(url_for('projects'))
@@ -179,6 +355,7 @@ def login():
         return f.redirect(url_for('login'))
     add_message('Welcome back %s'%(user.name))
     f.session['user_id'] = user.id
+    f.g.user = user
     return f.redirect(url_for('index'))
 
 @app.route('/logout')
@@ -200,7 +377,7 @@ def project_branches(pid):
     user = get_user()
 
     try:
-        project = md.Project.get(id=pid)
+        project = get_project()
     except:
         f.abort(404)
 
@@ -243,22 +420,33 @@ def commit(pid, cid):
     """ Returns information about a commit """
 
     try:
-        project = md.Project.get(id=pid)
+        project = get_project()
         commit = md.Commit.get(id=cid)
     except:
         f.abort(404)
     
-    return f.render_template('commit.html', commit=commit, project=project)
+    line_counts = dict((d.file_path, d) for d in md.CommitFileDiff
+        .select(md.CommitFileDiff.file_path, md.CommitFileDiff.added, 
+            md.CommitFileDiff.removed)
+        .where((md.CommitFileDiff.commit == commit)
+            & (md.CommitFileDiff.diff_key != md.CommitFileDiff.FAILED)))
+    last_log = (md.CommitLog.select(peewee.fn.MAX(md.CommitLog.id))
+        .where(md.CommitLog.commit == commit)
+        .scalar())
+    etag = page_etag('commit', commit.sha1, commit.status, last_log,
+        sorted((p, d.added, d.removed) for p, d in line_counts.items()))
+    return conditional(etag, lambda: f.render_template('commit.html', 
+        commit=commit, project=project, line_counts=line_counts))
 
 
 @app.route('/project/<int:pid>/commit/<int:cid>/<action>', methods=['POST'])
 @requires_user()
 def commit_action(pid, cid, action):
     user = get_user()
-    if action not in ['approve','review','reject','unreject','comment']:
+    if action not in md.Commit.ACTIONS:
         f.abort(404)
     try:
-        project = md.Project.get(id=pid)
+        project = get_project()
         commit = md.Commit.get(id=cid)
     except Exception as err:
         print "ERROR: %s"%(err)
@@ -267,54 +455,23 @@ def commit_action(pid, cid, action):
     def redirect_self():
         return f.redirect(url_for('commit', pid=pid, cid=cid))
 
-    if action == 'approve':
-        if commit.status not in ['reviewed','committed']:
-            f.abort(400)
-        if not user.has_project_role(project, 'approver'):
-            f.abort(403)
-        commit.status = 'approved'
-        commit.save()
-        md.CommitLog.create(user=user, commit=commit, message='Approved')
-        add_message('Commit updated')
-        return redirect_self()
-    
-    if action == 'review':
-        if not user.has_project_role(project, 'reviewer'):
+    try:
+        commit.apply_action(user, action, f.request.form.get('message'))
+    except md.ActionError as err:
+        if err.code == 403:
             f.abort(403)
-        if commit.status not in ['committed']:
-            f.abort(400)
-        commit.status = 'reviewed'
-        commit.save()
-        md.CommitLog.create(user=user, commit=commit, message='Reviewed')
-        add_message('Commit reviewed')
+        add_error(err.message)
         return redirect_self()
 
-    if action == 'reject':
-        if commit.status not in ['committed','reviewed','approved']:
-            add_error('Commit cannot be merged to reject')
-            return redirect_self()
-        commit.status = 'rejected'
-        commit.save()
-        md.CommitLog.create(user=user, commit=commit, message='Rejected')
-        add_message('Commit rejected')
-        return redirect_self()
-
-    if action == 'unreject':
-        if commit.status not in ['rejected']:
-            add_error('Commit must be rejected to unreject')
-            return redirect_self()
-        commit.status = 'committed'
-        commit.save()
-        return redirect_self()
-
-    if action == 'comment':
-        comment = f.request.form.get('message')
-        if not comment:
-            add_error('Comment cannot be blank')
-            return redirect_self()
-        md.CommitLog.create(user=user, commit=commit, message=comment)
-        add_message('Comment added')
-        return redirect_self()
+    messages = {
+        'approve': 'Commit updated',
+        'review': 'Commit reviewed',
+        'reject': 'Commit rejected',
+        'comment': 'Comment added',
+    }
+    if action in messages:
+        add_message(messages[action])
+    return redirect_self()
 
 @app.route('/project/<int:pid>/commit/<int:cid>/file')
 @requires_user()
@@ -331,7 +488,7 @@ def commit_file(pid, cid):
 
     try:
         fpath = f.request.args.get('fpath')
-        project = md.Project.get(id=pid)
+        project = get_project()
         commit = md.Commit.get(id=cid)
         commit_file = md.CommitFile.get(commit=commit, file_path=fpath)
     except:
@@ -346,21 +503,43 @@ def commit_file(pid, cid):
             ' resetting to 200 (max)')
         context = 200
 
-    diff = commit.project.git_control.get_unified_diff(
-        commit.sha1, commit_file.file_path, context=context,
-        branch=commit.branch)
-    if not diff:
-        diff = ("diff output: \"This commit's file changes "
-            "do not differ from stable\"")
+    git_control = commit.project.git_control
+    diff_key = git_control.get_diff_key(commit.sha1, commit_file.file_path,
+        context=context, branch=commit.branch)
+    etag = page_etag('commit_file', diff_key, commit.sha1, 
+        commit_file.change_type)
+    return conditional(etag, lambda: render_commit_file(commit, commit_file,
+        context, diff_key))
+
+def render_commit_file(commit, commit_file, context, diff_key):
+
+    """ Streams the diff page, from the cache or the daemon's stored
+    copy when there is one """
+
+    git_control = commit.project.git_control
+    diff = diff_cache.get(diff_key)
+    if diff is None:
+        # Rendered by the daemon when the commit came in
+        diff = md.CommitFileDiff.get_rendered(commit, commit_file.file_path,
+            diff_key)
+        if diff is not None:
+            diff_cache.set(diff_key, diff)
+    if diff is None:
+        unified = git_control.file_diff(commit.sha1, commit_file.file_path,
+            context=context, branch=commit.branch, timeout=DIFF_TIMEOUT)
+        # A diff cut short by the time limit is only good for this request
+        diff = diff_cache.tee(diff_key, 
+            render_html(profiler.timed('diff', unified)),
+            cacheable=lambda: not unified.degraded)
     else:
-        diff = diff.replace('<','&lt;')
-        diff = diff.replace('>','&gt;')
-        add_re = re.compile(r'^(\+.*?)$', flags=re.M)
-        rm_re = re.compile(r'^(\-.*?)$', flags=re.M)
-        diff = add_re.sub(r'<span class="code-line-added">\1</span>', diff)
-        diff = rm_re.sub(r'<span class="code-line-removed">\1</span>', diff)
-    return f.render_template('commit_file_diff.html', 
-        commit_file=commit_file, diff=diff, commit=commit, context=context)
+        diff = [diff]
+
+    # The session is saved before the body streams, so take the flashed
+    # messages out of it now
+    f.get_flashed_messages()
+    return f.Response(f.stream_with_context(stream_template(
+        'commit_file_diff.html', commit_file=commit_file, diff=diff, 
+        commit=commit, context=context)))
 
 @app.route('/project/<int:pid>/commits')
 @requires_user()
@@ -369,24 +548,27 @@ def commits(pid):
     """ Returns the HTML view for commits 
     accepts several filter arguments
 
-    GET param page - int: 1-based page number
+    GET param before - int: id of the last commit on the newer page
+    GET param after - int: id of the first commit on the older page
     GET param limit - int: The total number of commits to show
     GET param status_filter - string: comma separated string of 
         statuses to display. Empty defaults to all.
     """
 
     try:
-        project = md.Project.get(id=pid)
+        project = get_project()
     except:
         f.abort(404)
 
-    page = f.request.args.get('page',1)
+    before = f.request.args.get('before')
+    after = f.request.args.get('after')
     limit = f.request.args.get('limit',50)
     try:
-        page = int(page)
+        before = before and int(before)
+        after = after and int(after)
         limit = int(limit)
     except:
-        page = 1
+        before = after = None
         limit = 50
 
     status_filter = f.request.args.get('status_filter','').strip()
@@ -395,14 +577,122 @@ def commits(pid):
     if status_filter:
         statuses = status_filter.split(',')
     
-    #print "Statuses: ", statuses
-    commits = md.Commit.select().where(
-        (md.Commit.project == project) &
-        (md.Commit.status << statuses)
-    ).order_by(md.Commit.author_date.desc()).paginate(int(page), int(limit))
+    commits, has_newer, has_older = md.Commit.page(project, statuses, 
+        limit=limit, before=before, after=after)
     
-    return f.render_template('commits.html', project=project, 
-        statuses=statuses, commits=commits, page=page, limit=limit)
+    counts = md.CommitCounter.totals(project).get(project.id, {})
+    etag = page_etag('commits', [(c.id, c.status) for c in commits],
+        has_newer, has_older, sorted(counts.items()))
+    return conditional(etag, lambda: f.render_template('commits.html', 
+        project=project, statuses=statuses, commits=commits, limit=limit,
+        has_newer=has_newer, has_older=has_older, counts=counts))
+
+def touched_paths(commits, path):
+
+    """ Returns {commit id: [file paths]} for the files under path that
+    each of the commits touched """
+
+    path = path.strip('/')
+    touched = {}
+    if not commits:
+        return touched
+    for cf in (md.CommitFile
+            .select(md.CommitFile.commit, md.CommitFile.file_path)
+            .where((md.CommitFile.commit << [c.id for c in commits])
+                & ((md.CommitFile.file_path == path)
+                    | md.CommitFile.file_path.startswith(path + '/')))
+            .order_by(md.CommitFile.file_path)):
+        touched.setdefault(cf.commit_id, []).append(cf.file_path)
+    return touched
+
+@app.route('/project/<int:pid>/file')
+@requires_user()
+def file_history(pid):
+
+    """ Returns the HTML view for the commits that touched a file, or
+    any file under a directory
+
+    GET param path - string: the file or directory
+    GET param before - int: id of the last commit on the newer page
+    GET param after - int: id of the first commit on the older page
+    GET param status_filter - string: comma separated string of 
+        statuses to display. Empty defaults to all.
+    """
+
+    try:
+        project = get_project()
+    except md.Project.DoesNotExist:
+        f.abort(404)
+
+    path = f.request.args.get('path', '').strip('/')
+    if not path:
+        f.abort(404)
+    try:
+        before = int(f.request.args.get('before', 0)) or None
+        after = int(f.request.args.get('after', 0)) or None
+    except ValueError:
+        before = after = None
+    limit = 50
+
+    statuses = [s[0] for s in md.Commit.STATUSES]
+    status_filter = f.request.args.get('status_filter', '').strip()
+    if status_filter:
+        statuses = status_filter.split(',')
+
+    commits, has_newer, has_older = md.Commit.page(project, statuses,
+        limit=limit, before=before, after=after, path=path)
+    return f.render_template('file_history.html', project=project, 
+        path=path, statuses=statuses, commits=commits, has_newer=has_newer,
+        has_older=has_older, touched=touched_paths(commits, path))
+
+@app.route('/project/<int:pid>/search')
+@requires_user()
+def search(pid):
+
+    """ Returns the HTML view for searching a project's commits
+
+    GET param q - words to look for in messages, authors and paths
+    GET param path - string: start of a file path
+    GET param author - string: start of an author's name or email
+    GET param status - repeatable: statuses to include, defaults to all
+    GET param offset - int: number of results to skip
+    """
+
+    try:
+        project = get_project()
+    except md.Project.DoesNotExist:
+        f.abort(404)
+
+    args = f.request.args
+    text = args.get('q', '').strip()
+    path = args.get('path', '').strip()
+    author = args.get('author', '').strip()
+    statuses = args.getlist('status')
+    try:
+        offset = max(int(args.get('offset', 0)), 0)
+    except ValueError:
+        offset = 0
+    limit = 50
+
+    commits, has_more, paths = [], False, {}
+    searched = bool(text or path or author or statuses)
+    if searched and md.CommitSearch.exists():
+        commits, has_more = md.CommitSearch.search(project, text=text, 
+            path=path, author=author, statuses=statuses, limit=limit, 
+            offset=offset)
+        if path and commits:
+            for cf in (md.CommitFile
+                    .select(md.CommitFile.commit, md.CommitFile.file_path)
+                    .where((md.CommitFile.commit << [c.id for c in commits])
+                        & md.CommitFile.path_starts_with(path))
+                    .order_by(md.CommitFile.file_path)):
+                paths.setdefault(cf.commit_id, []).append(cf.file_path)
+
+    return f.render_template('search.html', project=project, text=text, 
+        path=path, author=author, statuses=statuses, commits=commits, 
+        paths=paths, has_more=has_more, offset=offset, limit=limit, 
+        searched=searched, available=md.CommitSearch.exists(),
+        all_statuses=[s[0] for s in md.Commit.STATUSES])
 
 @app.route('/project/<pid>/roles')
 @requires_user()
@@ -411,11 +701,11 @@ def project_roles(pid):
     """ Returns the HTML view for projects and role mappings """
  
     try:
-        project = md.Project.get(id=pid)
+        project = get_project()
     except:
         f.abort(404)
-    review_role = md.Role.get(name='reviewer')
-    approve_role = md.Role.get(name='approver')
+    review_role = md.Role.cached('reviewer')
+    approve_role = md.Role.cached('approver')
     reviewers = (md.ProjectRole.select()
         .where(
             (md.ProjectRole.project == project) &
@@ -434,7 +724,7 @@ def project_roles(pid):
 @app.route('/project/<pid>/role/add', methods=['POST'])
 def project_role_add(pid):
     try:
-        project = md.Project.get(id=pid)
+        project = get_project()
     except:
         f.abort(404)
 
@@ -446,7 +736,7 @@ def project_role_add(pid):
         
     try:
         user = md.User.get(email=user_email)
-        role = md.Role.get(name=role_name)
+        role = md.Role.cached(role_name)
     except:
         add_error('User or role not found')
         return f.redirect(url_for('project_roles', pid=project.id))
@@ -457,30 +747,115 @@ def project_role_add(pid):
     except:
         pass    
     pr = md.ProjectRole.create(user=user, role=role, project=project)
+    roles_changed()
     add_message('User role created!')
     return f.redirect(url_for('project_roles', pid=project.id))
 
 @app.route('/project/<pid>/role/delete', methods=['POST'])    
 def project_role_delete(pid):
     try:
-        project = md.Project.get(id=pid)
+        project = get_project()
     except:
         f.abort(404)
     user_email = f.request.form.get('user_email')
     role_name = f.request.form.get('role_name')
     try:
         user = md.User.get(email=user_email)
-        role = md.Role.get(name=role_name)
+        role = md.Role.cached(role_name)
         pr = md.ProjectRole.get(role=role, user=user, project=project)
     except Exception as err:
         f.abort(404)
     
     pr.delete_instance()
+    roles_changed()
     add_message('User removed from role: %s'%(role.name))
     return f.redirect(url_for('project_roles', pid=project.id))
 
+@app.route('/admin/diff-cache')
+@requires_admin()
+def admin_diff_cache():
+
+    """ Returns diff cache hit and miss counts and sizes as JSON """
+
+    return f.jsonify(diff_cache.stats())
+
+@app.template_filter('timestamp')
+def timestamp_filter(seconds):
+    return datetime.datetime.fromtimestamp(seconds).strftime(
+        '%Y-%m-%d %H:%M:%S')
+
+@app.route('/admin/git-trace')
+@requires_admin()
+def admin_git_trace():
+
+    """ Returns the HTML view of recently traced git commands, this
+    process' and the daemon's, and the slow command log """
+
+    return f.render_template('git_trace.html', enabled=gittrace.GIT_TRACE,
+        slow_seconds=gittrace.GIT_SLOW_SECONDS,
+        sections=[
+            ('Web application', gittrace.recent()),
+            ('Daemon', gittrace.daemon_recent()),
+            ('Slow commands', gittrace.slow()),
+        ])
+
+@app.route('/admin/profiles')
+@requires_admin()
+def admin_profiles():
+
+    """ Returns the HTML view of the slowest profiled requests """
+
+    return f.render_template('profiles.html', 
+        enabled=profiler.PROFILE_REQUESTS, profiles=profiler.stored(),
+        sections=profiler.SECTIONS + ['other'])
+
+@app.route('/admin/profiles/<profile_id>')
+@requires_admin()
+def admin_profile(profile_id):
+
+    """ Returns the HTML view of a profiled request
+
+    GET param sort - pstats sort key, cumulative or tottime
+    """
+
+    sort = f.request.args.get('sort', 'cumulative')
+    if sort not in ['cumulative', 'tottime', 'calls']:
+        sort = 'cumulative'
+    loaded = profiler.load(profile_id, sort=sort)
+    if loaded is None:
+        f.abort(404)
+    summary, stats = loaded
+    return f.render_template('profile.html', profile_id=profile_id,
+        summary=summary, stats=stats, sort=sort, 
+        sections=profiler.SECTIONS + ['other'])
+
+@app.route('/metrics')
+def metrics_text():
+
+    """ Returns this process' metrics in Prometheus' text format """
+
+    if not METRICS_ENABLED:
+        f.abort(404)
+    metrics.set_commit_counts(md.CommitCounter.totals(), dict(
+        md.Project.select(md.Project.id, md.Project.name).tuples()))
+    return f.Response(metrics.render(), mimetype=None, 
+        content_type=metrics.CONTENT_TYPE)
+
 @app.route('/projects')
 def projects():
     projects = md.Project.select()
-    return f.render_template('projects.html', projects=projects)
-
+    counts = md.CommitCounter.totals()
+    oldest_pending = {}
+    for pid, statuses in counts.items():
+        dates = [statuses[s][1] for s in md.Commit.PENDING_STATUSES 
+            if s in statuses]
+        if dates:
+            oldest_pending[pid] = min(dates)
+    return f.render_template('projects.html', projects=projects, 
+        counts=counts, oldest_pending=oldest_pending, 
+        statuses=md.Commit.STATUSES)
+
+
+# Imported last, since the API uses the helpers above
+from api import api
+app.register_blueprint(api)
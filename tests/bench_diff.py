@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Times gitgate.diff against difflib on generated files with 1% of their
+lines edited, printing seconds and output lines for each. Run from the
+repository root with
+
+    python tests/bench_diff.py [sizes...]
+
+"source" files have unique lines, like code. "lockfile" files repeat a
+few lines over and over, like package lockfiles, which is where
+difflib's autojunk heuristic gives up and reports most of the file as
+changed.
+"""
+import difflib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from gitgate import diff
+
+SIZES = [10000, 100000, 500000]
+CONTEXT = 3
+
+def source_lines(n, rand):
+    return ['line %d %d\n'%(i, rand.randrange(10 ** 6)) for i in xrange(n)]
+
+def lockfile_lines(n, rand):
+    lines = []
+    while len(lines) < n:
+        lines += ['  "pkg%d": {\n'%(rand.randrange(n // 10 + 1)),
+            '    "version": "1.0.%d",\n'%(rand.randrange(5)),
+            '    "dev": false\n',
+            '  },\n']
+    return lines[:n]
+
+def edit(lines, rand):
+
+    """ Returns a copy of lines with 1% of them replaced, deleted or
+    inserted """
+
+    lines = list(lines)
+    for _ in xrange(max(1, len(lines) // 100)):
+        pos = rand.randrange(len(lines))
+        op = rand.random()
+        if op < .4:
+            lines[pos] = '    "version": "2.0.%d",\n'%(rand.randrange(5))
+        elif op < .7:
+            del lines[pos]
+        else:
+            lines.insert(pos, '  },\n')
+    return lines
+
+def timed(fn):
+    start = time.time()
+    lines = fn()
+    return time.time() - start, len(lines)
+
+def main(sizes):
+    print('%-10s %8s %10s %10s %10s %10s'%('kind', 'lines', 'gitgate',
+        'output', 'difflib', 'output'))
+    for kind, make in [('source', source_lines),
+            ('lockfile', lockfile_lines)]:
+        for n in sizes:
+            rand = random.Random(n)
+            a = make(n, rand)
+            b = edit(a, rand)
+            ours = timed(lambda: list(diff.unified_diff(a, b, CONTEXT,
+                timeout=3600)))
+            theirs = timed(lambda: list(difflib.unified_diff(a, b,
+                n=CONTEXT)))
+            print('%-10s %8d %9.2fs %10d %9.2fs %10d'%((kind, n) + ours
+                + theirs))
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Tests for gitgate.diff. Run from the repository root with
+
+    python -m unittest discover tests
+"""
+import difflib
+import random
+import re
+import unittest
+
+from gitgate import diff
+
+# Long enough that no test runs out of time on a loaded machine
+TIMEOUT = 60
+
+def edited(lines, edits, rand, new_line):
+
+    """ Returns a copy of lines with edits random insertions, deletions
+    and replacements, new lines coming from new_line() """
+
+    lines = list(lines)
+    for _ in range(edits):
+        pos = rand.randrange(len(lines) + 1)
+        op = rand.choice('idr')
+        if op == 'i':
+            lines.insert(pos, new_line())
+        elif pos < len(lines):
+            if op == 'd':
+                del lines[pos]
+            else:
+                lines[pos] = new_line()
+    return lines
+
+def sides(codes, a, b):
+
+    """ Rebuilds both sides from opcodes, taking equal runs from a """
+
+    old, new = [], []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal':
+            old.extend(a[i1:i2])
+            new.extend(a[i1:i2])
+        else:
+            old.extend(a[i1:i2])
+            new.extend(b[j1:j2])
+    return old, new
+
+def unnumbered(line):
+
+    """ Strips unified_diff's line number, leaving difflib's format """
+
+    if line.startswith('@@'):
+        return line
+    code, rest = line[0], line[1:]
+    return code + rest.split(': ', 1)[1]
+
+def difflib_header(line):
+
+    """ Spells out the lengths of one, which difflib leaves off """
+
+    return re.sub(r'([-+]\d+)(?=[ ])', r'\1,1', line)
+
+class MatchLinesTest(unittest.TestCase):
+
+    def random_pairs(self, trials=2000):
+        rand = random.Random(1)
+        for _ in range(trials):
+            alphabet = rand.choice([2, 3, 5, 20])
+            a = [rand.randrange(alphabet)
+                for _ in range(rand.randrange(40))]
+            b = edited(a, rand.randrange(8), rand,
+                lambda: rand.randrange(alphabet))
+            yield a, b
+
+    def test_matches_are_equal_and_increasing(self):
+        for a, b in self.random_pairs():
+            for max_edits in [diff.DEFAULT_MAX_EDITS, 2]:
+                matches, degraded = diff.match_lines(a, b, TIMEOUT,
+                    max_edits)
+                self.assertFalse(degraded)
+                for i, j in matches:
+                    self.assertEqual(a[i], b[j])
+                for (i, j), (next_i, next_j) in zip(matches, matches[1:]):
+                    self.assertTrue(i < next_i and j < next_j)
+
+    def test_opcodes_rebuild_both_sides(self):
+        for a, b in self.random_pairs():
+            for max_edits in [diff.DEFAULT_MAX_EDITS, 2]:
+                codes, degraded = diff.opcodes(a, b, TIMEOUT, max_edits)
+                self.assertEqual(sides(codes, a, b), (a, b))
+
+    def test_timeout_degrades_to_replacements(self):
+        a = ['x', 'a', 'b', 'c', 'y']
+        b = ['x', 'c', 'b', 'a', 'y']
+        codes, degraded = diff.opcodes(a, b, timeout=-1)
+        self.assertTrue(degraded)
+        self.assertEqual(codes, [('equal', 0, 1, 0, 1),
+            ('replace', 1, 4, 1, 4), ('equal', 4, 5, 4, 5)])
+        self.assertEqual(sides(codes, a, b), (a, b))
+
+    def test_identical_sides_are_not_degraded(self):
+        a = ['x', 'y']
+        self.assertEqual(diff.match_lines(a, a, timeout=-1),
+            ([(0, 0), (1, 1)], False))
+
+class UnifiedDiffTest(unittest.TestCase):
+
+    def test_full_context_rebuilds_both_sides(self):
+        rand = random.Random(2)
+        for _ in range(500):
+            a = ['%d\n'%(rand.randrange(5))
+                for _ in range(rand.randrange(30))]
+            b = edited(a, rand.randrange(6), rand,
+                lambda: '%d\n'%(rand.randrange(5)))
+            unified = diff.unified_diff(a, b, context=len(a) + len(b),
+                timeout=TIMEOUT)
+            if a == b:
+                # No hunks at all, as with difflib
+                self.assertEqual(list(unified), [])
+                continue
+            old, new = [], []
+            for line in unified:
+                if line.startswith('@@'):
+                    continue
+                text = unnumbered(line)
+                if text[0] in ' -':
+                    old.append(text[1:])
+                if text[0] in ' +':
+                    new.append(text[1:])
+            self.assertEqual((old, new), (a, b))
+            self.assertFalse(unified.degraded)
+
+    def test_same_as_difflib_for_distinct_lines(self):
+        rand = random.Random(3)
+        for _ in range(1000):
+            a = ['%d\n'%(n)
+                for n in rand.sample(range(1000), rand.randrange(60))]
+            b = edited(a, rand.randrange(6), rand,
+                lambda: 'new %d\n'%(rand.randrange(10 ** 6)))
+            ours = [unnumbered(line)
+                for line in diff.unified_diff(a, b, 3, timeout=TIMEOUT)]
+            theirs = [difflib_header(line)
+                for line in difflib.unified_diff(a, b, n=3)][2:]
+            self.assertEqual(ours, theirs)
+
+    def test_line_numbers_follow_each_side(self):
+        to_lines = ['a\n', 'b\n', 'c\n']
+        from_lines = ['a\n', 'B\n', 'c\n', 'd\n']
+        self.assertEqual(list(diff.unified_diff(to_lines, from_lines, 1)), [
+            '@@ -1,3 +1,4 @@\n',
+            ' 0001: a\n',
+            '-0002: b\n',
+            '+0002: B\n',
+            ' 0003: c\n',
+            '+0004: d\n',
+        ])
+
+    def test_degraded_is_known_after_iterating(self):
+        unified = diff.unified_diff(['a\n', 'b\n'], ['b\n', 'a\n'],
+            timeout=-1)
+        self.assertEqual(unified.degraded, None)
+        list(unified)
+        self.assertTrue(unified.degraded)
+
+if __name__ == '__main__':
+    unittest.main()